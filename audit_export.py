@@ -0,0 +1,77 @@
+"""Export the moderation audit log as JSON lines or CSV.
+
+Reads the index and segments of every shard (SHARD_COUNT) next to the bot's data files:
+
+    python audit_export.py --since 2026-10-01 --until 2026-10-08 --format csv > modlog.csv
+    python audit_export.py --chat -1001234567890 --user 123456789
+
+Dates are Myanmar time. Entries are written oldest first.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+os.environ.setdefault('BOT_TOKEN', '0:export')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+FIELDS = ('ts', 'time', 'chat_id', 'action', 'user_id', 'user_name', 'actor_id', 'actor_name', 'reason', 'auto')
+
+
+def timestamp(value):
+    return bot_module.MYANMAR_TZ.localize(datetime.fromisoformat(value)).timestamp()
+
+
+def export(args):
+    shards = range(args.shards)
+    if args.chat is not None:
+        shards = [bot_module.shard_for_chat(args.chat, args.shards)]  # Only one shard holds a chat
+    entries = []
+    for shard in shards:
+        db_path = bot_module.shard_path(args.db, shard, args.shards)
+        if not os.path.exists(db_path):
+            continue
+        db = bot_module.SQLiteDatabase(db_path)
+        try:
+            audit = bot_module.AuditLog(db, bot_module.shard_path(args.audit_dir, shard, args.shards))
+            entries.extend(audit.query_sync(args.chat, args.user, args.since, args.until))
+        finally:
+            db.close()
+    if args.actor is not None:
+        entries = [entry for entry in entries if entry.get('actor_id') == args.actor]
+    entries.sort(key=lambda entry: entry['ts'])
+    for entry in entries:
+        entry['time'] = datetime.fromtimestamp(entry['ts'], bot_module.MYANMAR_TZ).isoformat()
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chat', type=int, help='Only this chat id')
+    parser.add_argument('--user', type=int, help='Only actions against this user id')
+    parser.add_argument('--actor', type=int, help='Only actions taken by this admin id')
+    parser.add_argument('--since', type=timestamp, help='YYYY-MM-DD[THH:MM], inclusive')
+    parser.add_argument('--until', type=timestamp, help='YYYY-MM-DD[THH:MM], exclusive')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--shards', type=int, default=bot_module.SHARD_COUNT)
+    parser.add_argument('--db', default=bot_module.USER_DB_FILE)
+    parser.add_argument('--audit-dir', default=bot_module.AUDIT_DIR)
+    args = parser.parse_args()
+
+    entries = export(args)
+    if args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+    else:
+        for entry in entries:
+            sys.stdout.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    print(f"Exported {len(entries)} entries", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
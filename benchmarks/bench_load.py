@@ -0,0 +1,167 @@
+"""Load-test SecurityBot against the in-process fake Bot API.
+
+Replays synthetic update streams through the real Application and handlers, with
+configurable Bot API latency and 429 injection, and reports throughput and
+p50/p99 latency per handler:
+
+    python benchmarks/bench_load.py --scenario all --updates 5000 --latency 0.05 --rate-limit-ratio 0.01
+
+Scenarios: messages (message flood), joins (join storm, which trips raid lockdown
+in the busiest chats), commands (admin command burst) and mixed (the FakeUpdateSource mix).
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def chat(chat_id):
+    return {'id': chat_id, 'type': 'supergroup', 'title': 'Load Test Group'}
+
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+
+def message_flood(count, chat_ids, rng):
+    now = int(time.time())
+    for update_id in range(1, count + 1):
+        yield {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': now, 'chat': chat(rng.choice(chat_ids)),
+            'from': user(rng.randrange(1000, 50000)), 'text': 'hi'}}
+
+
+def join_storm(count, chat_ids, rng):
+    now = int(time.time())
+    # Storms hit a few chats at once, so most joins land in the first chats
+    weights = [1 / (rank + 1) for rank in range(len(chat_ids))]
+    for update_id in range(1, count + 1):
+        member = user(100000 + update_id)
+        yield {'update_id': update_id, 'chat_member': {
+            'chat': chat(rng.choices(chat_ids, weights)[0]), 'from': member, 'date': now,
+            'old_chat_member': {'user': member, 'status': 'left'},
+            'new_chat_member': {'user': member, 'status': 'member'}}}
+
+
+def command_burst(count, chat_ids, rng, admin_id):
+    now = int(time.time())
+    commands = ['/status', '/showconfig', '/lookup @user{}', '/kick {}', '/ban {} spam', '/unban {}']
+    for update_id in range(1, count + 1):
+        text = rng.choice(commands).format(rng.randrange(1000, 50000))
+        command = text.split()[0]
+        yield {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': now, 'chat': chat(rng.choice(chat_ids)),
+            'from': user(admin_id), 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}}
+
+
+async def run_scenario(bot_module, name, updates, args):
+    from telegram import Update
+
+    fake_api = bot_module.FakeBotAPIRequest(
+        latency=args.latency, jitter=args.jitter, rate_limit_ratio=args.rate_limit_ratio, seed=args.seed)
+    bot = bot_module.SecurityBot(request=fake_api)
+    application = bot.application
+
+    samples = {}  # handler name -> latencies in seconds
+    handled = 0
+    done = asyncio.Event()
+
+    def measured(callback):
+        name = callback.__name__
+        latencies = samples.setdefault(name, [])
+
+        async def wrapper(update, context):
+            nonlocal handled
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                latencies.append(time.perf_counter() - started)
+                handled += 1
+                if handled == len(updates):
+                    done.set()
+
+        wrapper.__name__ = name
+        return wrapper
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = measured(handler.callback)
+
+    await application.initialize()
+    await application.start()
+    parsed = [Update.de_json(data, application.bot) for data in updates]
+    started = time.perf_counter()
+    for update in parsed:
+        application.update_queue.put_nowait(update)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    # Let replies and greetings already handed to the rate limiter go out
+    while any(bot.rate_limiter.stats()['queued']) and time.perf_counter() - started < elapsed + args.drain:
+        await asyncio.sleep(0.05)
+    drained = time.perf_counter() - started
+    await application.stop()
+    await bot.on_shutdown(application)
+    await application.shutdown()
+
+    calls = sum(fake_api.calls.values())
+    limited = sum(fake_api.rate_limited.values())
+    print(f"\n{name}: {len(updates)} updates handled in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s), "
+          f"outbound drained at {drained:.2f}s")
+    print(f"  Bot API calls: {calls} ({limited} got 429, {bot.rate_limiter.stats()['retries']} retried)")
+    print(f"  {'handler':18}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for handler, latencies in sorted(samples.items()):
+        if latencies:
+            latencies.sort()
+            print(f"  {handler:18}{len(latencies):8}{percentile(latencies, 0.5) * 1000:10.2f}"
+                  f"{percentile(latencies, 0.99) * 1000:10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=['messages', 'joins', 'commands', 'mixed', 'all'], default='all')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake Bot API latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- added to the latency')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='Share of calls answered with a 429')
+    parser.add_argument('--drain', type=float, default=30.0, help='Seconds to wait for queued sends afterwards')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Databases and config files go to a scratch directory, never the working tree
+    os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.chdir(tempfile.mkdtemp())
+    import telegram_security_bot as bot_module
+
+    rng = random.Random(args.seed)
+    chat_ids = [-1001000000000 - i for i in range(args.chats)]
+    admin_id = bot_module.ADMIN_USER_IDS[0]
+    streams = {
+        'messages': lambda: list(message_flood(args.updates, chat_ids, rng)),
+        'joins': lambda: list(join_storm(args.updates, chat_ids, rng)),
+        'commands': lambda: list(command_burst(args.updates, chat_ids, rng, admin_id)),
+        'mixed': lambda: list(bot_module.FakeUpdateSource(args.chats, args.updates, args.seed)),
+    }
+    names = list(streams) if args.scenario == 'all' else [args.scenario]
+    print(f"Fake Bot API: latency {args.latency * 1000:.0f}ms +/- {args.jitter * 1000:.0f}ms, "
+          f"{args.rate_limit_ratio:.1%} rate limited")
+    for name in names:
+        # Each scenario starts from empty databases
+        os.chdir(tempfile.mkdtemp())
+        asyncio.run(run_scenario(bot_module, name, streams[name](), args))
+
+
+if __name__ == '__main__':
+    main()
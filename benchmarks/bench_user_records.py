@@ -0,0 +1,144 @@
+"""Benchmark the message path of the user index: CPU per message and memory per user.
+
+Compares UserStore (slotted records, interned strings, change detection) against
+the dict-per-profile UserStore it replaced, which built a fresh dict and queued a
+write for every message.
+
+    python benchmarks/bench_user_records.py --users 100000 --messages 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+
+from telegram import User  # noqa: E402
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+
+class DictUserStore(bot_module.UserStore):
+    """Baseline: UserStore's message path before UserRecord, copied unchanged except
+    that the flush is scheduled through the shared WriteBehind.
+
+    Every message builds a new profile dict, moves it to the end of the LRU and
+    queues a user row and a membership row, even when nothing changed.
+    """
+
+    def _remember(self, profile):
+        user_id = profile['id']
+        old = self._profiles.get(user_id)
+        if old is not None and old['username'] and old['username'].lower() != (profile['username'] or '').lower():
+            self._by_username.pop(old['username'].lower(), None)
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        if profile['username']:
+            self._by_username[profile['username'].lower()] = user_id
+        while len(self._profiles) > self.cache_size:
+            _, evicted = self._profiles.popitem(last=False)
+            if evicted['username'] and self._by_username.get(evicted['username'].lower()) == evicted['id']:
+                del self._by_username[evicted['username'].lower()]
+
+    def observe(self, user, chat_id, status=bot_module.ChatMemberStatus.MEMBER):
+        profile = self._profiles.get(user.id)
+        cached = profile is not None
+        chats = profile['chats'] if cached else {}
+        chats[chat_id] = status
+        profile = {
+            'id': user.id,
+            'full_name': user.full_name,
+            'username': user.username,
+            'chat_id': chat_id,
+            'chats': chats,
+            'partial': profile['partial'] if cached else True,
+        }
+        self._remember(profile)
+        self._pending_users[user.id] = profile
+        self._pending_members[(chat_id, user.id)] = status
+        pending = len(self._pending_users) + len(self._pending_members)
+        self._writes.schedule(now=pending >= bot_module.USER_FLUSH_BATCH)
+
+    def _take_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        members, self._pending_members = self._pending_members, {}
+        now = time.time()
+        user_rows = [
+            (p['id'], p['username'] or '', (p['username'] or '').lower(), p['full_name'], p['chat_id'], now)
+            for p in users.values()
+        ]
+        member_rows = [(chat_id, user_id, status, now) for (chat_id, user_id), status in members.items()]
+        return user_rows, member_rows
+
+
+def make_users(count):
+    # Names arrive as fresh strings from each update's JSON, never shared objects
+    return [
+        User(i, ''.join(['First', str(i % 5000)]), False, last_name='Last',
+             username=''.join(['user', str(i)]))
+        for i in range(count)
+    ]
+
+
+def message_stream(users, chat_ids, count, seed=0):
+    rng = random.Random(seed)
+    # Activity is skewed: most messages come from a small set of talkative users
+    weights = [1 / (rank + 1) for rank in range(len(users))]
+    speakers = rng.choices(users, weights=weights, k=count)
+    return [(user, chat_ids[user.id % len(chat_ids)]) for user in speakers]
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    index = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return index, used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--chats', type=int, default=50)
+    args = parser.parse_args()
+
+    chat_ids = [-1001000000000 - i for i in range(args.chats)]
+    tmpdir = tempfile.mkdtemp()
+    db = bot_module.SQLiteDatabase(os.path.join(tmpdir, 'bench_users.db'))
+
+    def build(store_class):
+        store = store_class(db, cache_size=args.users)
+        for user in make_users(args.users):
+            store.observe(user, chat_ids[user.id % len(chat_ids)])
+        store._take_pending()  # As if the batch had been flushed
+        return store
+
+    baseline, baseline_bytes = measure_memory(lambda: build(DictUserStore))
+    store, store_bytes = measure_memory(lambda: build(bot_module.UserStore))
+
+    stream = message_stream(make_users(args.users), chat_ids, args.messages)
+    results = []
+    for name, index in (('dict profiles', baseline), ('UserStore', store)):
+        started = time.perf_counter()
+        for user, chat_id in stream:
+            index.observe(user, chat_id)
+        elapsed = time.perf_counter() - started
+        index._take_pending()
+        results.append((name, elapsed / len(stream) * 1e9))
+
+    print(f"{args.users} users, {args.messages} messages over {args.chats} chats")
+    print(f"{'':18}{'bytes/user':>12}{'ns/message':>12}")
+    for (name, ns), used in zip(results, (baseline_bytes, store_bytes)):
+        print(f"{name:18}{used / args.users:12.0f}{ns:12.0f}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
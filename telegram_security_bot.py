@@ -1,99 +1,2560 @@
 import logging
-from telegram import Update, ChatMember
-from telegram.ext import Application, CommandHandler, ChatMemberHandler, ContextTypes
+import logging.handlers
+from telegram import Bot, Update, ChatMember, ChatPermissions
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, ChatMemberHandler, ContextTypes, Updater
 from telegram.constants import ChatMemberStatus
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
 import os
 import json
+import asyncio
+import atexit
+import bisect
+from array import array
+import functools
+import glob
+import gzip
+import heapq
+import math
+import multiprocessing
+import queue
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import string
+import sys
+import threading
+import time
+import tracemalloc
+from collections import ChainMap, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from types import MappingProxyType
 import pytz
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Logging
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '100'))  # Keep 1 in N high-volume debug lines
+
+# Myanmar timezone
+MYANMAR_TZ = pytz.timezone('Asia/Yangon')
+
+class StructuredFormatter(logging.Formatter):
+    """Standard log line in Myanmar time, followed by any chat_id/user_id/handler fields."""
+
+    FIELDS = ('handler', 'chat_id', 'user_id')
+
+    def converter(self, timestamp):
+        return datetime.fromtimestamp(timestamp, MYANMAR_TZ).timetuple()
+    
+    def format(self, record):
+        line = super().format(record)
+        fields = [f"{name}={getattr(record, name)}" for name in self.FIELDS if getattr(record, name, None) is not None]
+        return f"{line} [{' '.join(fields)}]" if fields else line
+
+def setup_logging(level=LOG_LEVEL):
+    """Send log records through a queue so formatting and stream I/O happen off the event loop."""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger('httpx').setLevel(max(logging.WARNING, root.level))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
+_sample_counts = {}  # event -> occurrences seen
+
+def sampled(event, every=LOG_SAMPLE_EVERY):
+    """True for the first and then every Nth occurrence of a high-volume event."""
+    count = _sample_counts.get(event, 0)
+    _sample_counts[event] = count + 1
+    return count % every == 0
+
+def log_fields(handler, chat_id=None, user_id=None):
+    """Structured fields for logger calls: logger.info(..., extra=log_fields(...))."""
+    return {'handler': handler, 'chat_id': chat_id, 'user_id': user_id}
+
 # Bot configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+
+# Webhook mode is used when WEBHOOK_URL is set, long polling otherwise. On Heroku only
+# `web` dynos get PORT and HTTP traffic: scale web=1 for webhooks, worker=1 for polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL, e.g. https://example.herokuapp.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8443'))
+
+# Prometheus-style metrics on http://METRICS_HOST:METRICS_PORT/metrics (shard i uses METRICS_PORT + i)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 disables the endpoint
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+# On-demand profiling with /profile, or `kill -USR2 <pid>` (report written to PROFILE_DIR)
+PROFILE_INTERVAL = 0.005  # Seconds between CPU samples
+PROFILE_DEFAULT_SECONDS = int(os.getenv('PROFILE_SECONDS', '30'))
+PROFILE_MAX_SECONDS = 300
+PROFILE_TRACE_FRAMES = 25  # Stack depth kept per allocation, deep enough to reach the handler
+PROFILE_TOP = 25  # Rows per report section
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Updates of different chats are handled concurrently, each chat's in arrival order
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))  # Updates handled at once per process
+
+# Sharding: with SHARD_COUNT > 1 a dispatcher routes updates by chat_id to worker processes
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+UPDATE_SOURCE = os.getenv('UPDATE_SOURCE', 'telegram')  # 'telegram', or 'fake' for local testing
+FAKE_CHATS = int(os.getenv('FAKE_CHATS', '20'))
+FAKE_UPDATES = int(os.getenv('FAKE_UPDATES', '2000'))
 ADMIN_USER_IDS = [1925310270, 7137261147]  # PyaePPZ and shaneswa admin IDs
 ADMIN_USERNAMES = ["PyaePPZ", "shaneswa"]  # Admin usernames for reference
+ADMIN_USERNAMES_LOWER = {admin.lower() for admin in ADMIN_USERNAMES}
 
-# Myanmar timezone
-MYANMAR_TZ = pytz.timezone('Asia/Yangon')
+# Persistence tuning
+CONFIG_FLUSH_DELAY = float(os.getenv('CONFIG_FLUSH_DELAY', '2'))  # Seconds to coalesce config changes
+CONFIG_CACHE_SIZE = int(os.getenv('CONFIG_CACHE_SIZE', '5000'))  # Group configs kept in memory
+AUDIT_DIR = os.getenv('AUDIT_DIR', 'audit')  # Moderation audit log segments
+AUDIT_SEGMENT_BYTES = int(os.getenv('AUDIT_SEGMENT_BYTES', str(1 << 20)))  # Segment size before it is compressed
+AUDIT_FLUSH_DELAY = 1.0  # Seconds to batch audit entries before appending them
+GLOBAL_BAN_DB = os.getenv('GLOBAL_BAN_DB', 'global_bans.db')  # Shared by every shard
+GLOBAL_BAN_SNAPSHOT = os.getenv('GLOBAL_BAN_SNAPSHOT', 'global_bans.snapshot')  # Loaded at startup
+GLOBAL_BAN_REFRESH = float(os.getenv('GLOBAL_BAN_REFRESH', '15'))  # Seconds between shards picking up each other's changes
+USER_DB_FILE = os.getenv('USER_DB_FILE', 'users.db')
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))  # Users kept in memory
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '1'))  # Seconds between batched upserts
+USER_FLUSH_BATCH = 500  # Flush early once this many users are waiting
+ADMIN_CACHE_TTL = float(os.getenv('ADMIN_CACHE_TTL', '300'))  # Seconds a cached member status stays valid
+CHAT_INFO_TTL = float(os.getenv('CHAT_INFO_TTL', '300'))  # Seconds to reuse get_chat results
+MEMBER_COUNT_TTL = float(os.getenv('MEMBER_COUNT_TTL', '60'))  # Seconds to reuse member counts
+
+# Join/leave message batching defaults (overridable per group with /setgreetwindow)
+DEFAULT_GREETING_WINDOW = 10  # Seconds during which joins (or leaves) share one message
+DEFAULT_GREETING_MAX_NAMES = 20  # Names listed per message before "+N more"
+
+# Catch-up after downtime: membership updates older than this are netted out per chat
+STALE_UPDATE_AGE = float(os.getenv('STALE_UPDATE_AGE', '120'))  # Seconds
+CATCH_UP_QUIET = 3.0  # Seconds without stale updates in a chat before its backlog is summarized
+
+# Bulk moderation
+MODERATION_CONCURRENCY = int(os.getenv('MODERATION_CONCURRENCY', '8'))  # Targets handled at once
+MODERATION_SUMMARY_LINES = 15  # Skipped/failed targets listed in a bulk summary
+RECENT_JOINS_PER_CHAT = 1000  # Joiners remembered per chat for joined:<minutes> selections
+MODERATION_TITLES = {
+    'ban': ('🚫', 'Banned'), 'kick': ('👢', 'Kicked'), 'unban': ('✅', 'Unbanned'),
+    'mute': ('🔇', 'Muted'), 'unmute': ('🔊', 'Unmuted'),
+}
+MODERATION_PAST_TENSE = {action: title for action, (_, title) in MODERATION_TITLES.items()}
+RELEASE_ACTIONS = {'unban': 'ban', 'unmute': 'mute'}  # Action -> the timed action it ends
+ENDED_EXPIRATIONS = {  # Action -> pending expirations it makes moot
+    'ban': ('ban', 'mute', 'lockdown'),  # Banned users have no permissions to give back
+    'kick': ('ban', 'mute', 'lockdown'),  # Kicking unbans, and a rejoining member starts unrestricted
+    'unban': ('ban',),
+    'unmute': ('mute', 'lockdown'),
+}
+AUDIT_ICONS = {
+    'ban': '🚫', 'kick': '👢', 'unban': '✅', 'mute': '🔇', 'unmute': '🔊', 'lockdown': '🔒', 'unlock': '🔓',
+    'gban': '🌐', 'ungban': '🌐',
+}
+
+# Timed bans and mutes (/tempban, /tempmute)
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+EXPIRY_PRELOAD = 10000  # Soonest pending expirations held in memory; the rest stay on disk
+EXPIRY_BATCH = 20  # Expired actions lifted together
+EXPIRY_RETRY = 60  # Seconds before retrying a lift that failed
+MODLOG_DEFAULT_ENTRIES = 10  # Entries /modlog shows without a count
+MODLOG_MAX_ENTRIES = 50
+
+# Raid detection (threshold overridable per group with /setraid, 0 disables)
+RAID_WINDOW = int(os.getenv('RAID_WINDOW', '60'))  # Seconds of joins counted towards a raid
+RAID_BUCKETS = 12  # Ring-buffer slots per chat; the window slides in RAID_WINDOW / RAID_BUCKETS steps
+DEFAULT_RAID_THRESHOLD = int(os.getenv('RAID_JOIN_THRESHOLD', '15'))  # Joins within the window that start a lockdown
+RAID_LOCKDOWN_SECONDS = int(os.getenv('RAID_LOCKDOWN_SECONDS', '600'))  # Lockdown length, renewed while joins stay high
+LOCKDOWN_MIN_MUTE = 31  # Seconds; Telegram treats restrictions of under 30 seconds as permanent
+RAID_MAX_CHATS = 10000  # Chats whose join counters are kept; least recently joined are dropped first
+
+# Group configuration defaults, shared by every group; groups store only the fields they override.
+# When changing a default, bump the version and move the old values to RETIRED_GROUP_CONFIG_DEFAULTS
+# so copies saved by older releases keep following the defaults.
+GROUP_CONFIG_DEFAULTS_VERSION = 1
+GROUP_CONFIG_DEFAULTS = MappingProxyType({
+    'welcome_message': """
+🎉 မင်္ဂလာပါ {user_name} 😊
+
+💰 Smile Coin Selling by Pyae မှ နွေးထွေးစွာ ကြိုဆိုပါတယ်! 
+🤗 စိတ်ချစွာ၀ယ်ယူနိုင်ပါတယ်
+
+👑 Admin - @PyaePPZ
+
+🇲🇲 Myanmar Time: {myanmar_time}
+    """.strip(),
+    'goodbye_message': """
+👋 {user_name} 
+😢 List ထဲမှာမင်းရှိတယ်ဆိုတာသိလိုက်ရတဲ့အချိန်ကစပြီးကိုယ်ဟာသအား၀မ်းနည်းနေပါပြီ 
+💔 ကောင်းရာဘ၀ကိုပိုင်ဆိုင်ရပါစေဗျာ
+
+🇲🇲 Myanmar Time: {myanmar_time}
+
+😊 ကောင်းမွန်ပါစေ! Take care! 🌈
+    """.strip(),
+    'group_name': 'Default Group',
+    'greeting_window': DEFAULT_GREETING_WINDOW,
+    'greeting_max_names': DEFAULT_GREETING_MAX_NAMES,
+    'raid_threshold': DEFAULT_RAID_THRESHOLD,
+    'global_bans': False,  # Opt-in: ban members of the global ban list when they join
+})
+RETIRED_GROUP_CONFIG_DEFAULTS = ()  # Default mappings of earlier versions
+
+def strip_defaults(config):
+    """Drop fields that only repeat a current or retired default."""
+    defaults = (GROUP_CONFIG_DEFAULTS,) + RETIRED_GROUP_CONFIG_DEFAULTS
+    return {
+        key: value for key, value in config.items()
+        if not any(key in default and default[key] == value for default in defaults)
+    }
+
+# Outbound rate limiting (Telegram allows ~30 requests/s overall and ~20 messages/min per group)
+GLOBAL_RATE_LIMIT = float(os.getenv('GLOBAL_RATE_LIMIT', '30'))  # Requests per second
+CHAT_RATE_LIMIT = float(os.getenv('CHAT_RATE_LIMIT', '20')) / 60  # Messages per second per chat
+CHAT_BURST = 5  # Messages a quiet chat may send back to back
+MAX_SEND_RETRIES = 3  # Retries after a 429 before giving up
+
+# Priority lanes, lower runs first
+PRIORITY_MODERATION = 0  # Ban/kick/unban calls and their confirmations
+PRIORITY_COMMAND = 1  # Replies to commands
+PRIORITY_GREETING = 2  # Welcome and goodbye messages
+
+# Chat member updates are classified from the old and new status alone
+ADMIN_STATUSES = frozenset({ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+IN_CHAT_STATUSES = ADMIN_STATUSES | {ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED}
+RESTRICTED_OUTSIDE = 'restricted_outside'  # Restricted, but not currently in the chat
+MEMBER_JOIN, MEMBER_LEAVE, MEMBER_BAN = 'join', 'leave', 'ban'
+MEMBER_PROMOTE, MEMBER_DEMOTE, MEMBER_CHANGE = 'promote', 'demote', 'change'
+MODERATION_ENDPOINTS = {'banChatMember', 'unbanChatMember', 'restrictChatMember'}
+
+class Histogram:
+    """Cumulative-bucket latency histogram; observe() is one bisect and two additions."""
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """In-process counters, histograms and scrape-time gauges in the Prometheus text format.
+
+    Recording only touches dicts keyed by (name, labels); formatting happens when /metrics is read.
+    """
+
+    HELP = {
+        'bot_handler_seconds': ('histogram', 'Time spent in update handlers and the checks they call'),
+        'bot_handler_errors_total': ('counter', 'Exceptions raised out of update handlers'),
+        'bot_api_request_seconds': ('histogram', 'Bot API call latency, excluding time queued by the rate limiter'),
+        'bot_api_errors_total': ('counter', 'Failed Bot API calls by error type'),
+        'bot_api_retries_total': ('counter', 'Bot API calls retried after a 429'),
+    }
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> (help, fn returning a value or {labels: value})
+    
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+    
+    def gauge(self, name, help_text, fn):
+        self.gauges[name] = (help_text, fn)
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+    
+    def render(self):
+        lines = []
+        described = set()
+        
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name, *self.HELP.get(name, ('counter', name)))
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            describe(name, *self.HELP.get(name, ('histogram', name)))
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, (help_text, fn) in sorted(self.gauges.items()):
+            describe(name, 'gauge', help_text)
+            value = fn()
+            for labels, sample in (value.items() if isinstance(value, dict) else [((), value)]):
+                lines.append(f"{name}{self._labels(labels)} {sample}")
+        return "\n".join(lines) + "\n"
+    
+    async def serve(self, host, port):
+        """Start a minimal HTTP server answering GET /metrics; returns the asyncio server."""
+        async def handle(reader, writer):
+            try:
+                request_line = await reader.readline()
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass  # Headers are not needed
+                parts = request_line.decode('latin-1').split()
+                if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                    status, body = '200 OK', self.render().encode('utf-8')
+                else:
+                    status, body = '404 Not Found', b'not found\n'
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+                )
+                await writer.drain()
+            except Exception:
+                logger.exception("🚨 ERROR serving metrics")
+            finally:
+                writer.close()
+        
+        return await asyncio.start_server(handle, host, port)
+
+METRICS = Metrics()
+
+def _build_member_transitions():
+    """old state -> new state -> kind of event (None when nothing we track changed)."""
+    states = [*ChatMemberStatus, RESTRICTED_OUTSIDE]
+    table = {}
+    for old in states:
+        row = table[old] = {}
+        for new in states:
+            was_in, is_in = old in IN_CHAT_STATUSES, new in IN_CHAT_STATUSES
+            if old == new:
+                kind = None
+            elif is_in and not was_in:
+                kind = MEMBER_JOIN
+            elif was_in and not is_in:
+                kind = MEMBER_BAN if new == ChatMemberStatus.BANNED else MEMBER_LEAVE
+            elif new in ADMIN_STATUSES and old not in ADMIN_STATUSES:
+                kind = MEMBER_PROMOTE
+            elif old in ADMIN_STATUSES and new not in ADMIN_STATUSES and is_in:
+                kind = MEMBER_DEMOTE
+            else:
+                kind = MEMBER_CHANGE  # e.g. restricted, or a non-member banned
+            row[new] = kind
+    return table
+
+MEMBER_TRANSITIONS = _build_member_transitions()
+
+def classify_member_update(member_update):
+    """Sort a ChatMemberUpdated into MEMBER_JOIN, MEMBER_LEAVE, ...; None if it can be ignored."""
+    old, new = member_update.old_chat_member, member_update.new_chat_member
+    old_state = old.status if old.status != ChatMemberStatus.RESTRICTED or old.is_member else RESTRICTED_OUTSIDE
+    new_state = new.status if new.status != ChatMemberStatus.RESTRICTED or new.is_member else RESTRICTED_OUTSIDE
+    try:
+        return MEMBER_TRANSITIONS[old_state][new_state]
+    except KeyError:
+        return None  # A status this version of the library does not know
+
+def timed(callback, name=None):
+    """Wrap an async callable so its latency and escaping exceptions are recorded."""
+    labels = (('handler', name or callback.__name__),)
+    
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            METRICS.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            METRICS.observe('bot_handler_seconds', labels, time.perf_counter() - started)
+    
+    return wrapper
+
+class Profiler:
+    """Sampling CPU profile and tracemalloc snapshot of the event loop, on demand.
+
+    Nothing is installed while idle. During run() a thread reads the loop thread's
+    stack every PROFILE_INTERVAL seconds and tracemalloc records allocations; both stop
+    when it returns. Samples and allocations are charged to the innermost handler on
+    the stack, looked up in `handlers` (code object -> handler name).
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.running = False
+    
+    @staticmethod
+    def _label(code):
+        return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def _handler_of(self, codes):
+        for code in codes:
+            name = self.handlers.get(code)
+            if name is not None:
+                return name
+        return None
+    
+    async def run(self, seconds, interval=PROFILE_INTERVAL):
+        """Profile the next `seconds` of the running event loop and return the report text."""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        thread_id = threading.get_ident()
+        stacks = []
+        done = threading.Event()
+        
+        def sample():
+            while not done.wait(interval):
+                frame = sys._current_frames().get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stacks.append(tuple(stack))
+        
+        tracing = tracemalloc.is_tracing()  # Started with PYTHONTRACEMALLOC; leave it running
+        if not tracing:
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        sampler = threading.Thread(target=sample, name='profiler', daemon=True)
+        try:
+            before = tracemalloc.take_snapshot()
+            started = time.perf_counter()
+            sampler.start()
+            await asyncio.sleep(seconds)
+            done.set()
+            elapsed = time.perf_counter() - started
+            after = tracemalloc.take_snapshot()
+        finally:
+            done.set()
+            if not tracing:
+                tracemalloc.stop()
+            self.running = False
+        await asyncio.to_thread(sampler.join)
+        # The sampler's own stacks are not the bot's memory
+        ignore = [tracemalloc.Filter(False, __file__, line) for line in {line for _, _, line in sample.__code__.co_lines() if line}]
+        before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+        return await asyncio.to_thread(self._report, stacks, before, after, elapsed, interval)
+    
+    def _report(self, stacks, before, after, elapsed, interval):
+        by_handler, own, cumulative = {}, {}, {}
+        idle = 0
+        for stack in stacks:
+            if not stack or stack[0].co_name == 'select':
+                idle += 1  # Event loop waiting for I/O
+                continue
+            name = self._handler_of(stack) or '(outside handlers)'
+            by_handler[name] = by_handler.get(name, 0) + 1
+            own[stack[0]] = own.get(stack[0], 0) + 1
+            for code in set(stack):
+                cumulative[code] = cumulative.get(code, 0) + 1
+        busy = len(stacks) - idle
+        
+        # Allocations still alive at the end, made while the profile ran
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+        handler_lines = {}  # filename -> [(first line, last line, handler)]
+        for code, name in self.handlers.items():
+            lines = [line for _, _, line in code.co_lines() if line]
+            handler_lines.setdefault(code.co_filename, []).append((code.co_firstlineno, max(lines, default=0), name))
+        memory_by_handler = {}
+        for stat in after.compare_to(before, 'traceback'):
+            if stat.size_diff <= 0:
+                continue
+            name = '(outside handlers)'
+            for frame in reversed(stat.traceback):  # Most recent first, so the innermost handler wins
+                match = next((handler for first, last, handler in handler_lines.get(frame.filename, ())
+                              if first <= frame.lineno <= last), None)
+                if match:
+                    name = match
+                    break
+            count, size = memory_by_handler.get(name, (0, 0))
+            memory_by_handler[name] = (count + stat.count_diff, size + stat.size_diff)
+        sites = [stat for stat in after.compare_to(before, 'lineno') if stat.size_diff > 0][:PROFILE_TOP]
+        
+        def percent(count):
+            return f"{count / busy:6.1%}" if busy else "     -"
+        
+        lines = [
+            f"Profile of pid {os.getpid()} at {get_myanmar_time()}",
+            f"{elapsed:.1f}s, {len(stacks)} samples every {interval * 1000:g}ms, "
+            f"{busy} busy ({busy / max(len(stacks), 1):.0%}), {idle} waiting for I/O",
+            "",
+            "== CPU by handler (share of busy samples) ==",
+        ]
+        for name, count in sorted(by_handler.items(), key=lambda item: -item[1]):
+            lines.append(f"{percent(count)}  {count:7}  {name}")
+        lines += ["", "== Top functions, own time =="]
+        for code, count in sorted(own.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+            lines.append(f"{percent(count)}  {count:7}  {self._label(code)}")
+        lines += ["", "== Top functions, including callees =="]
+        for code, count in sorted(cumulative.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+            lines.append(f"{percent(count)}  {count:7}  {self._label(code)}")
+        lines += ["", "== Memory allocated during the profile and still held, by handler =="]
+        for name, (count, size) in sorted(memory_by_handler.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{size / 1024:10.1f} KiB  {count:8} blocks  {name}")
+        lines += ["", "== Top allocation sites =="]
+        for stat in sites:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size_diff / 1024:10.1f} KiB  {stat.count_diff:8} blocks  "
+                         f"{os.path.basename(frame.filename)}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+_myanmar_time_cache = {}  # strftime format -> (unix second, rendered string)
+
+def _format_myanmar_time(fmt):
+    """Render the current Myanmar time, reusing the result for the rest of the second."""
+    now = int(time.time())
+    cached = _myanmar_time_cache.get(fmt)
+    if cached is not None and cached[0] == now:
+        return cached[1]
+    rendered = datetime.fromtimestamp(now, MYANMAR_TZ).strftime(fmt)
+    _myanmar_time_cache[fmt] = (now, rendered)
+    return rendered
 
 def get_myanmar_time():
     """Get current time in Myanmar timezone."""
-    utc_now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-    myanmar_time = utc_now.astimezone(MYANMAR_TZ)
-    return myanmar_time.strftime('%Y-%m-%d %H:%M:%S %Z')
+    return _format_myanmar_time('%Y-%m-%d %H:%M:%S %Z')
+
+def format_until(timestamp):
+    """Myanmar time of a unix timestamp, for expiry times."""
+    return datetime.fromtimestamp(timestamp, MYANMAR_TZ).strftime('%Y-%m-%d %H:%M')
 
 def get_myanmar_time_short():
     """Get current time in Myanmar timezone (short format)."""
-    utc_now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-    myanmar_time = utc_now.astimezone(MYANMAR_TZ)
-    return myanmar_time.strftime('%H:%M:%S')
+    return _format_myanmar_time('%H:%M:%S')
+
+# Placeholders allowed in welcome/goodbye messages
+TEMPLATE_FIELDS = ('user_name', 'myanmar_time')
+
+class TemplateError(ValueError):
+    """A welcome/goodbye message that cannot be rendered."""
+
+class MessageTemplate:
+    """A welcome/goodbye message parsed once into literal text and placeholder names."""
+
+    __slots__ = ('source', 'parts')
+
+    def __init__(self, source, parts=None):
+        self.source = source
+        self.parts = parts if parts is not None else self._parse(source)  # [(is_field, text)]
+    
+    @staticmethod
+    def _parse(source):
+        parts = []
+        try:
+            for literal, field, spec, conversion in string.Formatter().parse(source):
+                if literal:
+                    parts.append((False, literal))
+                if field is None:
+                    continue
+                if field not in TEMPLATE_FIELDS:
+                    raise TemplateError(f"unknown placeholder {{{field}}}")
+                if spec or conversion:
+                    raise TemplateError(f"placeholder {{{field}}} cannot have a format")
+                parts.append((True, field))
+        except ValueError as e:
+            if isinstance(e, TemplateError):
+                raise
+            raise TemplateError(f"{e} (write {{{{ or }}}} for a literal brace)") from None
+        return parts
+    
+    @classmethod
+    def literal(cls, source):
+        """A template that renders its source verbatim."""
+        return cls(source, [(False, source)])
+    
+    def render(self, **values):
+        return ''.join([values[text] if is_field else text for is_field, text in self.parts])
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(source):
+    """Compiled form of a stored message; groups sharing a text share one compiled template.
+
+    Invalid stored texts are reported once and then sent verbatim instead of failing
+    on every join.
+    """
+    try:
+        return MessageTemplate(source)
+    except TemplateError as e:
+        logger.warning("⚠️ Invalid stored template, it will be sent as plain text: %s", e)
+        return MessageTemplate.literal(source)
+
+def parse_duration(text):
+    """Seconds in a duration like 30m, 2h or 1d12h; None if text is not one."""
+    total, number = 0, ''
+    for char in text.lower():
+        if char.isdigit():
+            number += char
+        elif char in DURATION_UNITS and number:
+            total += int(number) * DURATION_UNITS[char]
+            number = ''
+        else:
+            return None
+    return total if total and not number else None
+
+def is_bot_admin(user):
+    """True for the bot's own administrators (ADMIN_USER_IDS, or ADMIN_USERNAMES in any case)."""
+    return user.id in ADMIN_USER_IDS or bool(user.username and user.username.lower() in ADMIN_USERNAMES_LOWER)
+
+def placeholder_user(user_id):
+    """Stand-in for a user we only know by ID."""
+    return type('User', (), {
+        'id': user_id,
+        'full_name': f'User {user_id}',
+        'username': None
+    })()
+
+def parse_id_marker(token):
+    """User ID in an explicit `id:123456789` target, or None."""
+    if token[:3].lower() == 'id:' and token[3:].isdigit():
+        return int(token[3:])
+    return None
+
+def parse_joined_selector(token):
+    """Minutes in a 'joined:<minutes>' target selector, or None if token is not one."""
+    if token.startswith('joined:') and token[7:].isdigit() and int(token[7:]) > 0:
+        return int(token[7:])
+    return None
+
+class RecentJoins:
+    """The last few joiners of each chat, so a raid can be cleaned up with one command."""
+
+    def __init__(self, per_chat=RECENT_JOINS_PER_CHAT, max_chats=5000):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> deque of (monotonic time, user)
+    
+    def add(self, chat_id, user):
+        joins = self._chats.get(chat_id)
+        if joins is None:
+            joins = self._chats[chat_id] = deque(maxlen=self.per_chat)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        joins.append((time.monotonic(), user))
+    
+    def since(self, chat_id, seconds):
+        """Users who joined chat_id in the last `seconds`, oldest first."""
+        cutoff = time.monotonic() - seconds
+        joins = self._chats.get(chat_id, ())
+        return [user for joined_at, user in joins if joined_at >= cutoff]
+
+class SQLiteDatabase:
+    """One SQLite connection in WAL mode, only ever used from its own worker thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._conn = None
+        self.call(self._connect)
+    
+    def _connect(self, _conn):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn = conn
+    
+    def call(self, fn, *args):
+        """Run fn(conn, *args) on the database thread and wait for it (startup/shutdown only)."""
+        return self._executor.submit(lambda: fn(self._conn, *args)).result()
+    
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) on the database thread without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(self._conn, *args))
+    
+    def close(self):
+        self.call(lambda conn: conn.close())
+        self._executor.shutdown(wait=True)
+
+class WriteBehind:
+    """Batched, deferred writes for a store that keeps its own pending changes.
+
+    take() hands the pending changes over as the arguments of write(conn, ...), or
+    returns None if there are none. A batch is written `delay` seconds after the first
+    change, at once when the store asks for it, and by flush() on shutdown. Without a
+    running event loop it is written synchronously, unless sync is False.
+    """
+
+    def __init__(self, db, take, write, delay, what, sync=True):
+        self.db = db
+        self.delay = delay
+        self.what = what  # e.g. 'audit entries', for log messages
+        self.sync = sync
+        self._take = take
+        self._write = write
+        self._task = None
+    
+    def schedule(self, now=False):
+        """Make sure a flush is coming: after `delay`, or right away with now=True."""
+        if self._task is not None and not self._task.done():
+            if not now:
+                return
+            self._task.cancel()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self.sync:
+                self.flush_sync()  # No event loop yet (e.g. during startup)
+            return  # Otherwise picked up by the next change or the shutdown flush
+        self._task = loop.create_task(self._flush_later(0 if now else self.delay))
+    
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        await self.flush()
+    
+    async def flush(self):
+        """Write every pending change in one transaction."""
+        batch = self._take()
+        if batch is None:
+            return
+        count = sum(len(rows) for rows in batch)
+        try:
+            await self.db.run(self._write, *batch)
+            logger.debug("💾 Saved %d %s", count, self.what)
+        except Exception as e:
+            logger.error("❌ Error saving %d %s: %s", count, self.what, e)
+    
+    def flush_sync(self):
+        batch = self._take()
+        if batch is not None:
+            self.db.call(self._write, *batch)
+
+def _intern(value):
+    return sys.intern(value) if value else value
+
+class UserRecord:
+    """Compact profile of one user; names are interned so repeats share one string.
+
+    Most users are only ever seen in one of our groups, so the first membership is
+    stored inline and a dict is only allocated for the second one onwards.
+    """
+
+    __slots__ = ('id', 'full_name', 'username', 'username_key', 'chat_id', 'status', 'more_chats', 'partial')
+
+    def __init__(self, user_id, full_name, username, chat_id, status, partial):
+        self.id = user_id
+        self.full_name = _intern(full_name)
+        self.set_username(username)
+        self.chat_id = chat_id  # First chat the user was seen in
+        self.status = status  # Membership status in chat_id
+        self.more_chats = None  # Other chat_id -> status, if any
+        self.partial = partial  # True if more memberships may exist on disk only
+    
+    def set_username(self, username):
+        self.username = _intern(username)
+        # Interning both makes an already-lowercase username and its key one object
+        self.username_key = _intern(username.lower()) if username else None
+    
+    def status_in(self, chat_id):
+        if chat_id == self.chat_id:
+            return self.status
+        return self.more_chats.get(chat_id) if self.more_chats else None
+    
+    def set_status(self, chat_id, status):
+        if chat_id == self.chat_id:
+            self.status = status
+        else:
+            if self.more_chats is None:
+                self.more_chats = {}
+            self.more_chats[chat_id] = status
+    
+    @property
+    def chats(self):
+        """All known memberships as a new chat_id -> status dict."""
+        chats = {self.chat_id: self.status}
+        if self.more_chats:
+            chats.update(self.more_chats)
+        return chats
+
+class UserStore:
+    """User index persisted in SQLite: username -> id, id -> profile, (chat_id, user_id) -> membership.
+
+    Profiles live in an LRU hot tier of bounded size; changes are queued and upserted
+    in batches so the message path never waits on disk.
+    """
+
+    def __init__(self, db, cache_size=USER_CACHE_SIZE, flush_interval=USER_FLUSH_INTERVAL):
+        self.db = db
+        self.cache_size = cache_size
+        self._profiles = OrderedDict()  # user_id -> profile, least recently used first
+        self._by_username = {}  # username (lowercase) -> user_id, for cached profiles only
+        self._pending_users = {}  # user_id -> profile not yet written
+        self._pending_members = {}  # (chat_id, user_id) -> status not yet written
+        # Never written from observe() without a loop: that would be one transaction per message
+        self._writes = WriteBehind(db, self._take_pending, self._upsert, flush_interval,
+                                   'user and membership rows', sync=False)
+        db.call(self._create_schema)
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                username_key TEXT NOT NULL,
+                full_name TEXT,
+                chat_id INTEGER,
+                updated_at REAL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS users_username_key ON users (username_key)')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS memberships (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                updated_at REAL,
+                PRIMARY KEY (chat_id, user_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS memberships_user ON memberships (user_id)')
+        conn.commit()
+    
+    def __len__(self):
+        return len(self._profiles)
+    
+    @property
+    def pending_count(self):
+        """User and membership rows waiting to be written."""
+        return len(self._pending_users) + len(self._pending_members)
+    
+    def _forget_username(self, record):
+        if record.username_key and self._by_username.get(record.username_key) == record.id:
+            del self._by_username[record.username_key]
+    
+    def _remember(self, record):
+        self._profiles[record.id] = record
+        self._profiles.move_to_end(record.id)
+        if record.username_key:
+            self._by_username[record.username_key] = record.id
+        while len(self._profiles) > self.cache_size:
+            _, evicted = self._profiles.popitem(last=False)
+            self._forget_username(evicted)
+    
+    def observe(self, user, chat_id, status=None):
+        """Record a user seen in a chat; returns immediately, the write happens in the next batch.
+
+        status is the new membership status from a chat-member update; None means the
+        user was merely seen talking there. A user whose name, username and status in
+        this chat are unchanged costs a dict lookup and a comparison: nothing is
+        allocated or written.
+        """
+        record = self._profiles.get(user.id)
+        if record is None:
+            status = status or ChatMemberStatus.MEMBER
+            record = UserRecord(user.id, user.full_name, user.username, chat_id, status, True)
+            self._remember(record)
+            self._pending_users[user.id] = record
+            self._pending_members[(chat_id, user.id)] = status
+        else:
+            self._profiles.move_to_end(user.id)
+            full_name = user.full_name
+            if record.full_name != full_name or record.username != user.username:
+                self._forget_username(record)
+                record.full_name = _intern(full_name)
+                record.set_username(user.username)
+                if record.username_key:
+                    self._by_username[record.username_key] = record.id
+                self._pending_users[user.id] = record
+            current = record.status_in(chat_id)
+            if status is None:
+                # Talking proves presence but must not turn an admin back into a member
+                status = current or ChatMemberStatus.MEMBER
+            if current != status:
+                record.set_status(chat_id, status)
+                self._pending_members[(chat_id, user.id)] = status
+            elif user.id not in self._pending_users:
+                return
+        self._writes.schedule(now=self.pending_count >= USER_FLUSH_BATCH)
+    
+    async def _cached(self, user_id):
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self._profiles.move_to_end(user_id)
+            if profile.partial:
+                stored = await self.db.run(self._select_memberships, user_id)
+                for chat_id, status in stored.items():
+                    if profile.status_in(chat_id) is None:
+                        profile.set_status(chat_id, status)
+                profile.partial = False
+        return profile
+    
+    async def get_by_id(self, user_id):
+        """Return the profile for a user id, or None if the user was never seen."""
+        profile = await self._cached(user_id)
+        if profile is None:
+            profile = await self.db.run(self._select_profile, 'id = ?', user_id)
+            if profile is not None:
+                self._remember(profile)
+        return profile
+    
+    async def get(self, username):
+        """Return the profile for a username, or None."""
+        key = username.lower()
+        if not key:
+            return None
+        user_id = self._by_username.get(key)
+        if user_id is not None:
+            return await self._cached(user_id)
+        profile = await self.db.run(self._select_profile, 'username_key = ?', key)
+        if profile is None:
+            return None
+        cached = self._profiles.get(profile.id)
+        if cached is not None:
+            # The hot tier is newer than the database; the user may have changed username since
+            return cached if (cached.username or '').lower() == key else None
+        self._remember(profile)
+        return profile
+    
+    async def resolve(self, target):
+        """Resolve '@username' or a numeric id to a profile, or None."""
+        if target.lstrip('-').isdigit():
+            return await self.get_by_id(int(target))
+        return await self.get(target.lstrip('@'))
+    
+    def membership(self, chat_id, user_id):
+        """Last known status of a cached user in a chat, or None."""
+        profile = self._profiles.get(user_id)
+        return profile.status_in(chat_id) if profile is not None else None
+    
+    @staticmethod
+    def _select_profile(conn, where, value):
+        row = conn.execute(
+            f'SELECT id, full_name, username, chat_id FROM users WHERE {where} '
+            'ORDER BY updated_at DESC LIMIT 1',
+            (value,)
+        ).fetchone()
+        if row is None:
+            return None
+        chats = UserStore._select_memberships(conn, row[0])
+        record = UserRecord(row[0], row[1], row[2] or None, row[3], chats.pop(row[3], ChatMemberStatus.MEMBER), False)
+        for chat_id, status in chats.items():
+            record.set_status(chat_id, status)
+        return record
+    
+    @staticmethod
+    def _select_memberships(conn, user_id):
+        rows = conn.execute('SELECT chat_id, status FROM memberships WHERE user_id = ?', (user_id,))
+        return {chat_id: sys.intern(status) for chat_id, status in rows}
+    
+    def _take_pending(self):
+        if not self._pending_users and not self._pending_members:
+            return None
+        users, self._pending_users = self._pending_users, {}
+        members, self._pending_members = self._pending_members, {}
+        now = time.time()
+        user_rows = [
+            (r.id, r.username or '', r.username_key or '', r.full_name, r.chat_id, now)
+            for r in users.values()
+        ]
+        member_rows = [(chat_id, user_id, status, now) for (chat_id, user_id), status in members.items()]
+        return user_rows, member_rows
+    
+    @staticmethod
+    def _upsert(conn, user_rows, member_rows):
+        conn.executemany("""
+            INSERT INTO users (id, username, username_key, full_name, chat_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                username = excluded.username,
+                username_key = excluded.username_key,
+                full_name = excluded.full_name,
+                chat_id = excluded.chat_id,
+                updated_at = excluded.updated_at
+        """, user_rows)
+        conn.executemany("""
+            INSERT INTO memberships (chat_id, user_id, status, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                status = excluded.status,
+                updated_at = excluded.updated_at
+        """, member_rows)
+        conn.commit()
+    
+    async def flush(self):
+        """Write every pending change in one transaction."""
+        await self._writes.flush()
+    
+    def flush_sync(self):
+        self._writes.flush_sync()
+
+class GroupConfigStore:
+    """Per-group overrides of GROUP_CONFIG_DEFAULTS, persisted in SQLite as one JSON row per chat.
+
+    Values equal to a default are not stored, and a group left without overrides has
+    its row deleted. Rows are read on first use into an LRU of bounded size, so startup
+    time and memory do not grow with the number of groups ever joined; changes are
+    written together after CONFIG_FLUSH_DELAY.
+    """
+
+    SCHEMA_VERSION = 1  # PRAGMA user_version once the legacy JSON file has been imported
+
+    def __init__(self, db, cache_size=CONFIG_CACHE_SIZE, flush_delay=CONFIG_FLUSH_DELAY):
+        self.db = db
+        self.cache_size = cache_size
+        self._configs = OrderedDict()  # chat_id -> config, least recently used first
+        self._pending = {}  # chat_id -> config not yet written
+        self._loading = {}  # chat_id -> task reading the row
+        self._writes = WriteBehind(db, self._take_pending, self._upsert, flush_delay, 'group configurations')
+        db.call(self._create_schema)
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS group_configs (
+                chat_id INTEGER PRIMARY KEY,
+                config TEXT NOT NULL,
+                updated_at REAL
+            )
+        """)
+        conn.commit()
+    
+    def __len__(self):
+        return len(self._configs)
+    
+    @property
+    def pending_count(self):
+        """Groups whose changed configuration is waiting to be written."""
+        return len(self._pending)
+    
+    def migrated(self):
+        return self.db.call(lambda conn: conn.execute('PRAGMA user_version').fetchone()[0]) >= self.SCHEMA_VERSION
+    
+    def mark_migrated(self):
+        def mark(conn):
+            conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            conn.commit()
+        self.db.call(mark)
+    
+    def import_json(self, path, keep=None):
+        """Copy configs from a legacy JSON file (rows already stored win); keep(chat_id) filters them."""
+        with open(path, 'r', encoding='utf-8') as f:
+            configs = json.load(f)
+        now = time.time()
+        rows = [
+            (int(chat_id), self._encode(overrides), now)
+            for chat_id, overrides in ((chat_id, strip_defaults(config)) for chat_id, config in configs.items())
+            if overrides and (keep is None or keep(int(chat_id)))
+        ]
+        
+        def insert(conn):
+            conn.executemany('INSERT OR IGNORE INTO group_configs (chat_id, config, updated_at) VALUES (?, ?, ?)', rows)
+            conn.commit()
+        self.db.call(insert)
+        return len(rows), len(configs)
+    
+    @staticmethod
+    def _encode(config):
+        return json.dumps(config, ensure_ascii=False, separators=(',', ':'))
+    
+    @staticmethod
+    def _select(conn, chat_id):
+        row = conn.execute('SELECT config FROM group_configs WHERE chat_id = ?', (chat_id,)).fetchone()
+        # Rows saved by older releases hold full copies of the defaults; only real overrides are kept
+        return strip_defaults(json.loads(row[0])) if row is not None else {}
+    
+    def _remember(self, chat_id, config):
+        self._configs[chat_id] = config
+        self._configs.move_to_end(chat_id)
+        while len(self._configs) > self.cache_size:
+            self._configs.popitem(last=False)  # Unsaved changes stay referenced by _pending
+    
+    async def get(self, chat_id):
+        """Return the overrides stored for chat_id, empty if the group has none."""
+        config = self._configs.get(chat_id)
+        if config is not None:
+            self._configs.move_to_end(chat_id)
+            return config
+        config = self._pending.get(chat_id)
+        if config is None:
+            # Concurrent first accesses share one read, and so one dict
+            task = self._loading.get(chat_id)
+            if task is None:
+                task = self._loading[chat_id] = asyncio.ensure_future(self.db.run(self._select, chat_id))
+                task.add_done_callback(lambda done: self._loading.pop(chat_id, None) if self._loading.get(chat_id) is done else None)
+            config = await asyncio.shield(task)
+            cached = self._configs.get(chat_id)
+            if cached is not None:
+                return cached  # Loaded by a concurrent caller or replaced with put() meanwhile
+            # Parse and validate the group's templates once, when it is loaded
+            for key in ('welcome_message', 'goodbye_message'):
+                if key in config:
+                    compile_template(config[key])
+        self._remember(chat_id, config)
+        return config
+    
+    def put(self, chat_id, config):
+        """Store (or re-store after changing them) a chat's overrides; written in the next batch."""
+        self._remember(chat_id, config)
+        self._pending[chat_id] = config
+        self._writes.schedule()
+    
+    def _take_pending(self):
+        if not self._pending:
+            return None
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        rows, deleted = [], []
+        # Encoded on the event loop so the writer thread never sees a dict mid-update
+        for chat_id, config in pending.items():
+            overrides = strip_defaults(config)
+            if overrides:
+                rows.append((chat_id, self._encode(overrides), now))
+            else:
+                deleted.append((chat_id,))
+        return rows, deleted
+    
+    @staticmethod
+    def _upsert(conn, rows, deleted):
+        conn.executemany("""
+            INSERT INTO group_configs (chat_id, config, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET config = excluded.config, updated_at = excluded.updated_at
+        """, rows)
+        conn.executemany('DELETE FROM group_configs WHERE chat_id = ?', deleted)
+        conn.commit()
+    
+    async def flush(self):
+        """Write every changed config in one transaction."""
+        await self._writes.flush()
+    
+    def flush_sync(self):
+        self._writes.flush_sync()
+
+class AuditLog:
+    """Append-only moderation history in numbered JSON-lines segments, indexed in SQLite.
+
+    Entries are buffered and appended in batches on the database thread. A segment that
+    reaches AUDIT_SEGMENT_BYTES is gzip-compressed and a new one started. The index maps
+    chat, target user and time to (segment, offset), so a query reads only the segments
+    holding its results.
+    """
+
+    def __init__(self, db, directory=AUDIT_DIR, segment_bytes=AUDIT_SEGMENT_BYTES, flush_delay=AUDIT_FLUSH_DELAY):
+        self.db = db
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._buffer = []  # Entries not yet appended
+        self._writes = WriteBehind(db, self._take_pending, self._append, flush_delay, 'audit entries')
+        os.makedirs(directory, exist_ok=True)
+        self._segment = db.call(self._open)  # Segment being appended to; only touched on the database thread
+    
+    @property
+    def pending_count(self):
+        """Entries waiting to be appended."""
+        return len(self._buffer)
+    
+    def _path(self, segment, compressed=False):
+        return os.path.join(self.directory, f"{segment:06d}.jsonl{'.gz' if compressed else ''}")
+    
+    def _open(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS audit_index (
+                ts REAL NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER,
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS audit_by_chat ON audit_index (chat_id, ts)')
+        conn.execute('CREATE INDEX IF NOT EXISTS audit_by_user ON audit_index (user_id, ts)')
+        conn.execute('CREATE INDEX IF NOT EXISTS audit_by_time ON audit_index (ts)')
+        conn.commit()
+        raw, compressed = [], []
+        for name in os.listdir(self.directory):
+            if name.endswith('.jsonl'):
+                raw.append(int(name.split('.')[0]))
+            elif name.endswith('.jsonl.gz'):
+                compressed.append(int(name.split('.')[0]))
+        raw.sort()
+        for segment in raw[:-1]:
+            self._compress(segment)  # A rotation was interrupted
+        return raw[-1] if raw else max(compressed, default=0) + 1
+    
+    def _compress(self, segment):
+        tmp_path = f"{self._path(segment, True)}.tmp"
+        with open(self._path(segment), 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, self._path(segment, True))
+        os.remove(self._path(segment))
+    
+    def record(self, chat_id, action, user=None, actor=None, reason=None, auto=False, until=None):
+        """Queue an entry; returns immediately, it is appended in the next batch."""
+        entry = {'ts': time.time(), 'chat_id': chat_id, 'action': action}
+        if until is not None:
+            entry['until'] = until
+        if user is not None:
+            entry['user_id'] = user.id
+            entry['user_name'] = user.full_name
+        if actor is not None:
+            entry['actor_id'] = actor.id
+            entry['actor_name'] = actor.full_name
+        if reason:
+            entry['reason'] = reason
+        if auto:
+            entry['auto'] = True
+        self._buffer.append(entry)
+        self._writes.schedule()
+    
+    def _take_pending(self):
+        if not self._buffer:
+            return None
+        entries, self._buffer = self._buffer, []
+        return (entries,)
+    
+    def _append(self, conn, entries):
+        rows = []
+        with open(self._path(self._segment), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for entry in entries:
+                line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+                rows.append((entry['ts'], entry['chat_id'], entry.get('user_id'), self._segment, offset))
+                f.write(line)
+                offset += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+        conn.executemany('INSERT INTO audit_index (ts, chat_id, user_id, segment, offset) VALUES (?, ?, ?, ?, ?)', rows)
+        conn.commit()
+        if offset >= self.segment_bytes:
+            self._compress(self._segment)
+            self._segment += 1
+    
+    async def flush(self):
+        await self._writes.flush()
+    
+    def flush_sync(self):
+        self._writes.flush_sync()
+    
+    def _read(self, segment, offsets):
+        """Entries at the given offsets of one segment."""
+        path = self._path(segment)
+        opener = open if os.path.exists(path) else gzip.open
+        if opener is gzip.open:
+            path = self._path(segment, True)
+        entries = []
+        with opener(path, 'rb') as f:
+            for offset in sorted(offsets):
+                f.seek(offset)  # Forward seeks in a gzip segment only decompress what they skip
+                entries.append(json.loads(f.readline()))
+        return entries
+    
+    def _query(self, conn, chat_id, user_id, since, until, limit):
+        where, params = [], []
+        for clause, value in (('chat_id = ?', chat_id), ('user_id = ?', user_id), ('ts >= ?', since), ('ts < ?', until)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        sql = 'SELECT segment, offset FROM audit_index'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ts DESC'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        by_segment = {}
+        for segment, offset in conn.execute(sql, params):
+            by_segment.setdefault(segment, []).append(offset)
+        entries = [entry for segment, offsets in by_segment.items() for entry in self._read(segment, offsets)]
+        entries.sort(key=lambda entry: entry['ts'], reverse=True)
+        return entries
+    
+    async def query(self, chat_id=None, user_id=None, since=None, until=None, limit=None):
+        """Entries matching every given filter, newest first."""
+        await self.flush()
+        return await self.db.run(self._query, chat_id, user_id, since, until, limit)
+    
+    def query_sync(self, chat_id=None, user_id=None, since=None, until=None, limit=None):
+        self.flush_sync()
+        return self.db.call(self._query, chat_id, user_id, since, until, limit)
+
+class GlobalBanList:
+    """Fleet-wide ban list; checking a joining user is one set lookup.
+
+    The list is a table in a database shared by all shards. Every change gets a
+    sequence number, so a process only reads the changes made since it last looked.
+    The in-memory set is saved as a snapshot (the sequence number followed by the
+    ids, all int64) so a restart is one file read plus the changes since.
+    """
+
+    def __init__(self, db, snapshot_path):
+        self.db = db
+        self.snapshot_path = snapshot_path
+        self._ids = set()
+        self._seq = 0  # Last change applied to _ids
+        self._snapshot_seq = 0  # Last change saved in the snapshot
+        db.call(self._create_schema)
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS global_bans (
+                user_id INTEGER PRIMARY KEY,
+                banned INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                actor_id INTEGER,
+                reason TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS global_bans_seq ON global_bans (seq)')
+        conn.commit()
+    
+    def __contains__(self, user_id):
+        return user_id in self._ids
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def load(self):
+        """Read the snapshot and the changes made after it (startup only)."""
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+            if data and len(data) % 8 == 0:
+                ids = array('q')
+                ids.frombytes(data)
+                values = iter(ids)
+                self._seq = self._snapshot_seq = next(values)
+                self._ids = set(values)
+        except FileNotFoundError:
+            pass
+        self._apply(self.db.call(self._changes, self._seq))
+        if self._seq != self._snapshot_seq:
+            self.save_snapshot()
+    
+    def save_snapshot(self):
+        ids = array('q', [self._seq])
+        ids.extend(self._ids)
+        tmp = f'{self.snapshot_path}.{os.getpid()}.tmp'  # Shards may save at the same time
+        with open(tmp, 'wb') as f:
+            ids.tofile(f)
+        os.replace(tmp, self.snapshot_path)
+        self._snapshot_seq = self._seq
+    
+    @staticmethod
+    def _changes(conn, seq):
+        return conn.execute(
+            'SELECT user_id, banned, seq FROM global_bans WHERE seq > ? ORDER BY seq', (seq,)
+        ).fetchall()
+    
+    def _apply(self, rows):
+        for user_id, banned, seq in rows:
+            if banned:
+                self._ids.add(user_id)
+            else:
+                self._ids.discard(user_id)
+            self._seq = seq
+    
+    async def refresh(self):
+        """Pick up changes made by other processes."""
+        rows = await self.db.run(self._changes, self._seq)
+        self._apply(rows)
+        return len(rows)
+    
+    @staticmethod
+    def _write(conn, user_ids, banned, actor_id, reason):
+        conn.execute('BEGIN IMMEDIATE')  # Sequence numbers stay unique across shards
+        try:
+            (seq,) = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM global_bans').fetchone()
+            now = time.time()
+            conn.executemany("""
+                INSERT INTO global_bans (user_id, banned, seq, actor_id, reason, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET banned = excluded.banned, seq = excluded.seq,
+                    actor_id = excluded.actor_id, reason = excluded.reason, updated_at = excluded.updated_at
+            """, [(user_id, banned, seq + i, actor_id, reason, now) for i, user_id in enumerate(user_ids, 1)])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    
+    async def add(self, user_ids, actor_id=None, reason=None):
+        """Put users on the list; returns how many were not on it yet."""
+        await self.refresh()
+        new = [user_id for user_id in user_ids if user_id not in self._ids]
+        await self.db.run(self._write, user_ids, 1, actor_id, reason)
+        await self.refresh()
+        return len(new)
+    
+    async def remove(self, user_ids, actor_id=None):
+        """Take users off the list; returns how many were on it."""
+        await self.refresh()
+        listed = [user_id for user_id in user_ids if user_id in self._ids]
+        if listed:
+            await self.db.run(self._write, listed, 0, actor_id, None)
+            await self.refresh()
+        return len(listed)
+    
+    def close(self):
+        if self._seq != self._snapshot_seq:
+            self.save_snapshot()
+        self.db.close()
+
+class ExpiryScheduler:
+    """Persistent expirations of timed bans and mutes, driven by a single timer.
+
+    Every pending expiration is a row in SQLite indexed by expires_at. At most
+    EXPIRY_PRELOAD of the soonest sit in a heap: past that, the latest half is dropped
+    back to disk-only, and when the heap runs dry the next slice is read through the
+    index. Scheduling, cancelling and expiring are amortized O(log n) and nothing
+    ever scans all pending entries. Due entries are lifted EXPIRY_BATCH at a time
+    through lift(chat_id, user_id, action), whose API calls go through the rate limiter.
+    """
+
+    def __init__(self, db, lift, preload=EXPIRY_PRELOAD, batch=EXPIRY_BATCH):
+        self.db = db
+        self.lift = lift
+        self.preload = preload
+        self.batch = batch
+        self._heap = []  # (expires_at, chat_id, user_id, action) for entries before _horizon
+        self._due = {}  # (chat_id, user_id, action) -> expires_at; heap entries not in here are stale
+        self._horizon = 0.0  # Entries expiring at or after this are on disk only
+        self._timer = None
+        self._runner = None
+        db.call(self._create_schema)
+    
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS expirations (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                action TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, user_id, action)
+            ) WITHOUT ROWID
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS expirations_due ON expirations (expires_at)')
+        conn.commit()
+    
+    def __len__(self):
+        return len(self._due)
+    
+    async def start(self):
+        """Load the soonest expirations and arm the timer; call with the event loop running."""
+        await self._load()
+        self._arm()
+    
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._runner is not None:
+            self._runner.cancel()
+    
+    @staticmethod
+    def _select(conn, start, limit):
+        return conn.execute(
+            'SELECT expires_at, chat_id, user_id, action FROM expirations WHERE expires_at >= ? '
+            'ORDER BY expires_at LIMIT ?', (start, limit)
+        ).fetchall()
+    
+    @staticmethod
+    def _select_at(conn, expires_at):
+        return conn.execute(
+            'SELECT expires_at, chat_id, user_id, action FROM expirations WHERE expires_at = ?', (expires_at,)
+        ).fetchall()
+    
+    async def _load(self):
+        """Move the next slice of expirations from disk into the heap."""
+        rows = await self.db.run(self._select, self._horizon, self.preload)
+        if len(rows) < self.preload:
+            horizon = math.inf
+        else:
+            # Entries sharing the last timestamp may be cut off by the LIMIT; leave them all for the next slice
+            horizon = rows[-1][0]
+            rows = [row for row in rows if row[0] < horizon]
+            if not rows:
+                rows = await self.db.run(self._select_at, horizon)
+                horizon = math.nextafter(horizon, math.inf)
+        for expires_at, chat_id, user_id, action in rows:
+            key = (chat_id, user_id, action)
+            if key not in self._due:
+                self._due[key] = expires_at
+                heapq.heappush(self._heap, (expires_at, chat_id, user_id, action))
+        self._horizon = horizon
+    
+    @staticmethod
+    def _upsert(conn, rows):
+        conn.executemany("""
+            INSERT INTO expirations (chat_id, user_id, action, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id, action) DO UPDATE SET expires_at = excluded.expires_at
+        """, rows)
+        conn.commit()
+    
+    @staticmethod
+    def _delete(conn, rows):
+        conn.executemany(
+            'DELETE FROM expirations WHERE chat_id = ? AND user_id = ? AND action = ? AND expires_at = ?', rows)
+        conn.commit()
+    
+    async def schedule(self, chat_id, user_id, action, expires_at):
+        """Lift action for user_id in chat_id at expires_at (unix time), replacing any earlier schedule."""
+        await self.db.run(self._upsert, [(chat_id, user_id, action, expires_at)])
+        key = (chat_id, user_id, action)
+        self._due.pop(key, None)  # Any older heap entry for the key is now stale
+        if expires_at < self._horizon:
+            self._due[key] = expires_at
+            heapq.heappush(self._heap, (expires_at, chat_id, user_id, action))
+            if self._heap[0][0] == expires_at:
+                self._arm()
+        self._trim()
+    
+    def _trim(self):
+        """Keep the heap within `preload` live entries and free of too many stale ones."""
+        if len(self._due) > self.preload:
+            # The latest entries are already on disk; lower the horizon so they are read back later
+            ordered = sorted(self._due.items(), key=lambda item: item[1])
+            horizon = ordered[self.preload // 2][1]
+            self._due = {key: expires_at for key, expires_at in ordered if expires_at < horizon}
+            self._horizon = horizon
+        elif len(self._heap) <= 2 * len(self._due) + 64:
+            return
+        # Rebuild from the live entries, dropping rescheduled and cancelled ones
+        self._heap = [(expires_at, *key) for key, expires_at in self._due.items()]
+        heapq.heapify(self._heap)
+        self._arm()
+    
+    async def release_chat(self, chat_id, action):
+        """Expire every pending `action` in chat_id now, e.g. the lockdown mutes on /lockdown off."""
+        rows = await self.db.run(lambda conn: conn.execute(
+            'SELECT user_id FROM expirations WHERE chat_id = ? AND action = ?', (chat_id, action)).fetchall())
+        now = time.time()
+        for (user_id,) in rows:
+            await self.schedule(chat_id, user_id, action, now)
+        return len(rows)
+    
+    async def cancel(self, chat_id, user_id, action):
+        """Forget a pending expiration, e.g. after a manual unban."""
+        self._due.pop((chat_id, user_id, action), None)
+        await self.db.run(lambda conn: (
+            conn.execute('DELETE FROM expirations WHERE chat_id = ? AND user_id = ? AND action = ?',
+                         (chat_id, user_id, action)),
+            conn.commit(),
+        ))
+        self._trim()
+    
+    def _arm(self):
+        """Point the one timer at the soonest expiration."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._heap:
+            self._timer = loop.call_later(max(self._heap[0][0] - time.time(), 0), self._wake)
+        elif self._horizon != math.inf:
+            self._timer = loop.call_soon(self._wake)  # Read the next slice from disk
+    
+    def _wake(self):
+        self._timer = None
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.get_running_loop().create_task(self._run_due())
+    
+    async def _run_due(self):
+        while True:
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch:
+                expires_at, chat_id, user_id, action = heapq.heappop(self._heap)
+                key = (chat_id, user_id, action)
+                if self._due.get(key) == expires_at:
+                    del self._due[key]
+                    batch.append((chat_id, user_id, action, expires_at))
+            if batch:
+                await self._expire(batch)
+            elif not self._heap and self._horizon != math.inf:
+                await self._load()
+            else:
+                break
+        self._arm()
+    
+    async def _expire(self, batch):
+        results = await asyncio.gather(*(self.lift(chat_id, user_id, action) for chat_id, user_id, action, _ in batch),
+                                       return_exceptions=True)
+        retry_at = time.time() + EXPIRY_RETRY
+        for (chat_id, user_id, action, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.warning("❌ Could not lift %s, retrying in %ds: %s", action, EXPIRY_RETRY, result,
+                               extra=log_fields('expirations', chat_id, user_id))
+                await self.schedule(chat_id, user_id, action, retry_at)
+        lifted = [row for row, result in zip(batch, results) if not isinstance(result, Exception)]
+        if lifted:
+            # Matching on expires_at keeps rows that were rescheduled while we were lifting
+            await self.db.run(self._delete, lifted)
+
+class TTLCache:
+    """Async read-through cache with per-entry expiry and single-flight fetching.
+
+    Concurrent misses for the same key share one fetch; failed fetches are not cached.
+    """
+
+    def __init__(self, ttl, max_size=50000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._inflight = {}  # key -> task fetching the value
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def peek(self, key):
+        """Return the cached value or None, without fetching."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+    
+    async def get(self, key, fetch):
+        """Return the cached value, calling the coroutine function fetch() on a miss."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._load(key, fetch))
+            self._inflight[key] = task
+        # Shield so one cancelled caller does not cancel the fetch for everyone else
+        return await asyncio.shield(task)
+    
+    async def _load(self, key, fetch):
+        task = asyncio.current_task()
+        try:
+            value = await fetch()
+        except BaseException:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+            raise
+        # Only store if nobody invalidated the key while we were fetching
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            self.set(key, value)
+        return value
+    
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def update(self, key, fn):
+        """Replace a cached value with fn(value), keeping its expiry; no-op on a miss."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries[key] = (entry[0], fn(entry[1]))
+    
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        self._inflight.pop(key, None)
+
+class BotReadCache:
+    """Cached, single-flight front for the read-only Bot API calls used by the handlers."""
+
+    def __init__(self, chat_ttl=CHAT_INFO_TTL, member_count_ttl=MEMBER_COUNT_TTL):
+        self._me = TTLCache(float('inf'), max_size=1)  # The bot's own identity never changes
+        self._chats = TTLCache(chat_ttl)
+        self._member_counts = TTLCache(member_count_ttl)
+    
+    async def get_me(self, bot):
+        return await self._me.get('me', bot.get_me)
+    
+    async def get_chat(self, bot, chat_id):
+        return await self._chats.get(chat_id, lambda: bot.get_chat(chat_id))
+    
+    async def get_chat_member_count(self, bot, chat_id):
+        return await self._member_counts.get(chat_id, lambda: bot.get_chat_member_count(chat_id))
+    
+    def adjust_member_count(self, chat_id, delta):
+        """Apply a join (+1) or leave (-1) we already saw to the cached count."""
+        self._member_counts.update(chat_id, lambda count: max(count + delta, 0))
+    
+    def forget_chat(self, chat_id):
+        self._chats.invalidate(chat_id)
+        self._member_counts.invalidate(chat_id)
+
+class JoinWindow:
+    """Join counter for one chat: a ring of per-slot counts plus their running total."""
+
+    __slots__ = ('counts', 'head', 'total', 'locked_until')
+
+    def __init__(self, buckets):
+        self.counts = array('I', bytes(4 * buckets))
+        self.head = 0  # Absolute index of the newest slot
+        self.total = 0
+        self.locked_until = 0.0
+    
+    def advance(self, slot):
+        """Move the window forward to slot, dropping the counts that slid out of it."""
+        buckets = len(self.counts)
+        if slot - self.head >= buckets:
+            self.counts = array('I', bytes(4 * buckets))
+            self.total = 0
+        else:
+            for stale in range(self.head + 1, slot + 1):
+                self.total -= self.counts[stale % buckets]
+                self.counts[stale % buckets] = 0
+        self.head = max(self.head, slot)
+
+class RaidDetector:
+    """Sliding-window join counts per chat that put a chat into lockdown when they spike.
+
+    Each join costs one ring-buffer update, and only RAID_MAX_CHATS windows are kept.
+    """
+
+    def __init__(self, window=RAID_WINDOW, buckets=RAID_BUCKETS, lockdown=RAID_LOCKDOWN_SECONDS, max_chats=RAID_MAX_CHATS):
+        self.buckets = buckets
+        self.slot_seconds = window / buckets
+        self.lockdown = lockdown
+        self.max_chats = max_chats
+        self._windows = OrderedDict()  # chat_id -> JoinWindow, least recently joined first
+    
+    def _window(self, chat_id):
+        window = self._windows.get(chat_id)
+        if window is None:
+            window = self._windows[chat_id] = JoinWindow(self.buckets)
+            if len(self._windows) > self.max_chats:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(chat_id)
+        return window
+    
+    def record_join(self, chat_id, threshold, now=None):
+        """Count a join and return True if it starts a lockdown (threshold 0 never does)."""
+        now = time.monotonic() if now is None else now
+        window = self._window(chat_id)
+        slot = int(now / self.slot_seconds)
+        window.advance(slot)
+        window.counts[slot % self.buckets] += 1
+        window.total += 1
+        if not threshold or window.total < threshold:
+            return False
+        started = window.locked_until <= now
+        window.locked_until = now + self.lockdown
+        return started
+    
+    def joins(self, chat_id, now=None):
+        """Joins counted in chat_id's current window."""
+        window = self._windows.get(chat_id)
+        if window is None:
+            return 0
+        window.advance(int((time.monotonic() if now is None else now) / self.slot_seconds))
+        return window.total
+    
+    def locked_for(self, chat_id, now=None):
+        """Seconds of lockdown left in chat_id, 0 if it is not locked."""
+        window = self._windows.get(chat_id)
+        if window is None:
+            return 0
+        return max(window.locked_until - (time.monotonic() if now is None else now), 0)
+    
+    def lock(self, chat_id, seconds=None):
+        self._window(chat_id).locked_until = time.monotonic() + (self.lockdown if seconds is None else seconds)
+    
+    def unlock(self, chat_id):
+        window = self._windows.get(chat_id)
+        if window is not None:
+            window.locked_until = 0.0
+
+class GreetingBatcher:
+    """Merge joins (or leaves) in a chat that arrive within a time window into one message.
+
+    The first event in a quiet chat is sent right away and opens a window; events that
+    arrive while it is open are collected and sent together when it closes.
+    """
+
+    def __init__(self, send):
+        self.send = send  # async send(bot, chat_id, kind, names)
+        self._windows = {}  # (chat_id, kind) -> names collected in the open window
+        self._closers = set()  # Tasks closing the open windows
+        self._closing = None  # Event set by flush() to close every window at once
+    
+    def pending(self):
+        return sum(len(names) for names in self._windows.values())
+    
+    async def add(self, bot, chat_id, kind, name, window):
+        key = (chat_id, kind)
+        names = self._windows.get(key)
+        if names is not None:
+            names.append(name)
+            return
+        if window > 0:
+            if self._closing is None:
+                self._closing = asyncio.Event()
+            self._windows[key] = []
+            closer = asyncio.get_running_loop().create_task(self._close_window(bot, key, window))
+            self._closers.add(closer)
+            closer.add_done_callback(self._closers.discard)
+        await self.send(bot, chat_id, kind, [name])
+    
+    async def _close_window(self, bot, key, window):
+        while True:
+            try:
+                await asyncio.wait_for(self._closing.wait(), window)
+            except asyncio.TimeoutError:
+                pass
+            names = self._windows[key]
+            if not names or self._closing.is_set():
+                del self._windows[key]
+            else:
+                self._windows[key] = []  # Keep the window open while the storm continues
+            if names:
+                try:
+                    await self.send(bot, key[0], key[1], names)
+                except Exception as e:
+                    logger.error("❌ Failed to send batched %s message for %d members: %s", key[1], len(names), e,
+                                 extra=log_fields('greetings', chat_id=key[0]))
+            if key not in self._windows:
+                return
+    
+    async def flush(self):
+        """Close every open window now and send the names it collected (on shutdown)."""
+        if self._closers:
+            self._closing.set()
+            await asyncio.gather(*self._closers)
+
+class CatchUpBatcher:
+    """Net out the joins and leaves of a backlog replayed after downtime.
+
+    Stale membership changes are collected per chat and user: someone who joined and
+    left again (or left and came back) cancels out. Once a chat's backlog has been quiet
+    for CATCH_UP_QUIET seconds, flush(bot, chat_id, joined, left) gets the users whose
+    membership really changed.
+    """
+
+    def __init__(self, flush, quiet=CATCH_UP_QUIET):
+        self.flush = flush
+        self.quiet = quiet
+        self._chats = {}  # chat_id -> {user_id: [was_member at first, is_member at last, user]}
+        self._last = {}  # chat_id -> monotonic time of the latest stale update
+    
+    def pending(self):
+        return sum(len(users) for users in self._chats.values())
+    
+    def add(self, bot, chat_id, user, was_member, is_member):
+        users = self._chats.get(chat_id)
+        if users is None:
+            users = self._chats[chat_id] = {}
+            asyncio.get_running_loop().create_task(self._close(bot, chat_id))
+        entry = users.get(user.id)
+        if entry is None:
+            users[user.id] = [was_member, is_member, user]
+        else:
+            entry[1] = is_member
+            entry[2] = user
+        self._last[chat_id] = time.monotonic()
+    
+    async def _close(self, bot, chat_id):
+        self._last[chat_id] = time.monotonic()
+        while (wait := self._last[chat_id] + self.quiet - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+        del self._last[chat_id]
+        users = self._chats.pop(chat_id)
+        joined = [user for was_member, is_member, user in users.values() if is_member and not was_member]
+        left = [user for was_member, is_member, user in users.values() if was_member and not is_member]
+        logger.info("🔄 Caught up on %d members: %d joined, %d left", len(users), len(joined), len(left),
+                    extra=log_fields('catch_up', chat_id))
+        try:
+            await self.flush(bot, chat_id, joined, left)
+        except Exception as e:
+            logger.error("❌ Failed to summarize missed joins/leaves: %s", e, extra=log_fields('catch_up', chat_id))
+
+class TokenBucket:
+    """Classic token bucket; also remembers a Telegram retry_after pause."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Paces every Bot API request with a global and a per-chat token bucket.
+
+    Requests wait in priority lanes (see PRIORITY_*) and a single dispatcher grants
+    them in lane order, skipping over chats that are out of tokens so one flooding
+    group cannot hold up the others. A priority can be forced per call with
+    ``rate_limit_args={'priority': ...}``; otherwise it is inferred from the endpoint.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE_LIMIT, chat_rate=CHAT_RATE_LIMIT, chat_burst=CHAT_BURST,
+                 max_retries=MAX_SEND_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+        self._lanes = [deque() for _ in range(PRIORITY_GREETING + 1)]
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.sent = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    async def initialize(self):
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+    
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+    
+    def stats(self):
+        """Queue depth per lane and wait times, for /status and monitoring."""
+        return {
+            'queued': [len(lane) for lane in self._lanes],
+            'sent': self.sent,
+            'retries': self.retries,
+            'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+            'max_wait': self.max_wait,
+        }
+    
+    @staticmethod
+    def _priority(endpoint, data, rate_limit_args):
+        if isinstance(rate_limit_args, dict) and 'priority' in rate_limit_args:
+            return rate_limit_args['priority']
+        if endpoint in MODERATION_ENDPOINTS:
+            return PRIORITY_MODERATION
+        if endpoint == 'sendMessage' and not (data.get('reply_parameters') or data.get('reply_to_message_id')):
+            return PRIORITY_GREETING
+        return PRIORITY_COMMAND
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = self._priority(endpoint, data, rate_limit_args)
+        # Only messages count against the per-chat limit; moderation calls share the global one
+        chat_id = data.get('chat_id') if endpoint.startswith(('send', 'copy', 'forward', 'edit')) else None
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_id)
+            labels = (('endpoint', endpoint),)
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                METRICS.inc('bot_api_errors_total', labels + (('error', 'RetryAfter'),))
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                METRICS.inc('bot_api_retries_total', labels)
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.pause(e.retry_after)
+                logger.warning("⏳ Rate limited on %s, retrying in %ss", endpoint, e.retry_after,
+                               extra=log_fields('rate_limiter', chat_id=chat_id))
+            except Exception as e:
+                METRICS.inc('bot_api_errors_total', labels + (('error', type(e).__name__),))
+                raise
+            finally:
+                METRICS.observe('bot_api_request_seconds', labels, time.perf_counter() - started)
+    
+    async def _acquire(self, priority, chat_id):
+        grant = asyncio.get_running_loop().create_future()
+        queued_at = time.monotonic()
+        self._lanes[priority].append((chat_id, grant))
+        self._wakeup.set()
+        try:
+            await grant
+        except asyncio.CancelledError:
+            if not grant.done():
+                grant.cancel()  # The dispatcher skips cancelled grants
+            raise
+        waited = time.monotonic() - queued_at
+        self.sent += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+    
+    def _next_ready(self, now):
+        """Pop the first grant whose chat has a token; else return the shortest wait."""
+        shortest = None
+        for lane in self._lanes:
+            for index, (chat_id, grant) in enumerate(lane):
+                if grant.cancelled():
+                    del lane[index]
+                    return None, 0.0
+                if chat_id is None:
+                    del lane[index]
+                    return grant, None
+                bucket = self._chat_bucket(chat_id)
+                wait = bucket.delay(now)
+                if wait <= 0:
+                    bucket.take()
+                    del lane[index]
+                    return grant, None
+                shortest = wait if shortest is None else min(shortest, wait)
+                if index >= 100:
+                    break  # Bound the scan; the rest waits behind busy chats
+        return None, shortest
+    
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            grant, wait = self._next_ready(now)
+            if grant is not None:
+                self.global_bucket.take()
+                grant.set_result(None)
+                continue
+            if wait == 0.0:
+                continue  # Dropped a cancelled request, look again
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates concurrently, but one at a time and in arrival order within a chat.
+
+    The base class would take its semaphore before the chat lock, so one busy chat's
+    backlog could hold every slot; here the cap is applied once the chat's turn comes.
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        # process_update() takes the base semaphore before do_process_update() runs, so it
+        # must never block; the real cap is self._slots
+        self._semaphore = asyncio.Semaphore(2 ** 30)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chats = {}  # chat_id -> [lock, updates holding or waiting for it]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        # Tasks reach this point in arrival order and asyncio.Lock wakes waiters FIFO
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+    
+    def busy_chats(self):
+        """Chats with an update running or waiting."""
+        return len(self._chats)
+
+def shard_path(path, shard_index, shard_count):
+    """Per-shard name for a data file, e.g. users.db -> users.shard1of4.db."""
+    if shard_count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_index}of{shard_count}{ext}"
+
+def shard_for_chat(chat_id, shard_count):
+    return chat_id % shard_count
+
+def existing_layouts(path=USER_DB_FILE):
+    """Shard counts that have data files for `path`, e.g. {1: ['users.db'], 4: ['users.shard0of4.db', ...]}."""
+    root, ext = os.path.splitext(path)
+    layouts = {1: [path]} if os.path.exists(path) else {}
+    for candidate in glob.glob(f"{glob.escape(root)}.shard*of*{glob.escape(ext)}"):
+        match = re.fullmatch(r'\.shard(\d+)of(\d+)', candidate[len(root):len(candidate) - len(ext)])
+        if match:
+            layouts.setdefault(int(match[2]), []).append(candidate)
+    return layouts
+
+def retire_data_files(db_path, audit_dir):
+    """Move a database and its audit segments out of the way, keeping them for reference."""
+    stamp = int(time.time())
+    while any(os.path.exists(f"{path}.retired-{stamp}") for path in (db_path, audit_dir)):
+        stamp += 1  # Never overwrite files retired earlier
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm", audit_dir):
+        if os.path.exists(path):
+            os.replace(path, f"{path}.retired-{stamp}")
+
+def seed_shard(shard_index, shard_count, sources):
+    """Copy this shard's chats out of the databases of another shard layout.
+
+    sources is a list of (database path, audit directory). Group configs, memberships,
+    users, pending expirations and audit entries are copied for the chats that
+    shard_for_chat() assigns to this shard; the database is then marked migrated.
+    """
+    db = SQLiteDatabase(shard_path(USER_DB_FILE, shard_index, shard_count))
+    try:
+        # Creating the stores creates their tables
+        configs = GroupConfigStore(db)
+        UserStore(db)
+        ExpiryScheduler(db, None)
+        audit = AuditLog(db, shard_path(AUDIT_DIR, shard_index, shard_count))
+        
+        def copy_rows(conn, source):
+            conn.create_function('in_shard', 1, lambda chat_id: shard_for_chat(chat_id, shard_count) == shard_index,
+                                 deterministic=True)
+            conn.execute('ATTACH DATABASE ? AS src', (source,))
+            try:
+                tables = {name for (name,) in conn.execute("SELECT name FROM src.sqlite_master WHERE type = 'table'")}
+                if 'group_configs' in tables:
+                    conn.execute('INSERT OR IGNORE INTO group_configs (chat_id, config, updated_at) '
+                                 'SELECT chat_id, config, updated_at FROM src.group_configs WHERE in_shard(chat_id)')
+                if 'memberships' in tables:
+                    conn.execute('INSERT OR IGNORE INTO memberships (chat_id, user_id, status, updated_at) '
+                                 'SELECT chat_id, user_id, status, updated_at FROM src.memberships WHERE in_shard(chat_id)')
+                if 'users' in tables:
+                    conn.execute('INSERT OR IGNORE INTO users (id, username, username_key, full_name, chat_id, updated_at) '
+                                 'SELECT id, username, username_key, full_name, chat_id, updated_at FROM src.users '
+                                 'WHERE in_shard(chat_id) OR id IN (SELECT user_id FROM memberships)')
+                if 'expirations' in tables:
+                    conn.execute('INSERT OR IGNORE INTO expirations (chat_id, user_id, action, expires_at) '
+                                 'SELECT chat_id, user_id, action, expires_at FROM src.expirations WHERE in_shard(chat_id)')
+                conn.commit()
+            finally:
+                conn.execute('DETACH DATABASE src')
+        
+        for source, audit_dir in sources:
+            db.call(copy_rows, source)
+            if not os.path.isdir(audit_dir):
+                continue
+            # Audit entries are re-appended, since the old index points into the old segments
+            segments = sorted(name for name in os.listdir(audit_dir) if name.endswith(('.jsonl', '.jsonl.gz')))
+            for name in segments:
+                opener = gzip.open if name.endswith('.gz') else open
+                with opener(os.path.join(audit_dir, name), 'rb') as f:
+                    entries = [entry for entry in map(json.loads, f)
+                               if shard_for_chat(entry['chat_id'], shard_count) == shard_index]
+                if entries:
+                    db.call(audit._append, entries)
+        configs.mark_migrated()
+    finally:
+        db.close()
+
+def migrate_shard_layout(shard_count=SHARD_COUNT):
+    """Carry the data over when the shard count changed since the last start (1 -> 4, 4 -> 8, 4 -> 1...).
+
+    The newest other layout is split by shard_for_chat() into this layout's databases,
+    then every other layout is retired so it is never mistaken for current data again.
+    Raises if the copy fails, rather than starting with empty databases.
+    """
+    layouts = existing_layouts()
+    current = layouts.pop(shard_count, [])
+    if not layouts:
+        return
+    
+    def migrated(path):
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute('PRAGMA user_version').fetchone()[0] >= GroupConfigStore.SCHEMA_VERSION
+        finally:
+            conn.close()
+    
+    done = {path for path in current if migrated(path)}
+    if len(done) == shard_count:
+        logger.warning("⚠️ Retiring data files of other shard layouts %s; this layout is already in use", sorted(layouts))
+    else:
+        source_count = max(layouts, key=lambda count: max(os.path.getmtime(path) for path in layouts[count]))
+        sources = [
+            (shard_path(USER_DB_FILE, index, source_count), shard_path(AUDIT_DIR, index, source_count))
+            for index in range(source_count)
+        ]
+        missing = [path for path, _ in sources if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"Cannot move from {source_count} to {shard_count} shard(s): {', '.join(missing)} missing")
+        logger.info("🧩 Moving data from %d to %d shard(s)", source_count, shard_count)
+        for index in range(shard_count):
+            path = shard_path(USER_DB_FILE, index, shard_count)
+            if path in done:
+                continue
+            # Left over from an interrupted move; start this shard again
+            retire_data_files(path, shard_path(AUDIT_DIR, index, shard_count))
+            seed_shard(index, shard_count, sources)
+            logger.info("✅ Seeded %s", path)
+    for count in layouts:
+        for index in range(count):
+            retire_data_files(shard_path(USER_DB_FILE, index, count), shard_path(AUDIT_DIR, index, count))
+
+def update_chat_id(data):
+    """Chat id of a raw update dict, or 0 for updates that are not tied to a chat."""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'chat_member', 'my_chat_member', 'chat_join_request'):
+        if key in data:
+            return data[key]['chat']['id']
+    if 'callback_query' in data and 'message' in data['callback_query']:
+        return data['callback_query']['message']['chat']['id']
+    return 0
+
+class FakeBotAPIRequest(BaseRequest):
+    """In-process stand-in for the Bot API, so the bot can run offline against fake updates.
+
+    latency (seconds, with +/- jitter) is slept before every response, and a random
+    rate_limit_ratio of calls other than getUpdates get a 429 asking to retry after retry_after.
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Security Bot', 'username': 'fake_security_bot'}
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_ratio=0.0, retry_after=1, seed=0):
+        self.calls = {}  # endpoint -> number of calls
+        self.rate_limited = {}  # endpoint -> number of 429 responses
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self._message_id = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def respond(self, endpoint, params):
+        """Return the 'result' field of a successful response to endpoint."""
+        chat = {'id': params.get('chat_id', 0), 'type': 'supergroup', 'title': f"Chat {params.get('chat_id', 0)}"}
+        if endpoint == 'getMe':
+            return self.BOT_USER
+        if endpoint in ('sendMessage', 'sendDocument'):
+            self._message_id += 1
+            return {'message_id': self._message_id, 'date': int(time.time()), 'chat': chat,
+                    'from': self.BOT_USER, 'text': params.get('text', '')}
+        if endpoint == 'getChat':
+            return chat
+        if endpoint == 'getChatMemberCount':
+            return 100
+        if endpoint == 'getChatMember':
+            user = {'id': params.get('user_id', 0), 'is_bot': False, 'first_name': 'Member'}
+            return {'user': user, 'status': 'member'}
+        if endpoint == 'getUpdates':
+            return []
+        return True
+    
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+        if endpoint != 'getUpdates' and self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio:
+            self.rate_limited[endpoint] = self.rate_limited.get(endpoint, 0) + 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }).encode('utf-8')
+        params = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({'ok': True, 'result': self.respond(endpoint, params)}).encode('utf-8')
+
+class FakeUpdateSource:
+    """Synthetic update stream: messages plus joins and leaves spread over a set of chats."""
+
+    def __init__(self, chat_count=FAKE_CHATS, update_count=FAKE_UPDATES, seed=0):
+        self.chat_ids = [-1001000000000 - i for i in range(chat_count)]
+        self.update_count = update_count
+        self.random = random.Random(seed)
+    
+    def __iter__(self):
+        now = int(time.time())
+        for update_id in range(1, self.update_count + 1):
+            chat = {'id': self.random.choice(self.chat_ids), 'type': 'supergroup', 'title': 'Fake Group'}
+            user_id = self.random.randrange(1000, 50000)
+            user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+            roll = self.random.random()
+            if roll < 0.9:
+                yield {'update_id': update_id, 'message': {
+                    'message_id': update_id, 'date': now, 'chat': chat, 'from': user, 'text': 'hi'}}
+            else:
+                joined = roll < 0.95
+                old, new = ('left', 'member') if joined else ('member', 'left')
+                yield {'update_id': update_id, 'chat_member': {
+                    'chat': chat, 'from': user, 'date': now,
+                    'old_chat_member': {'user': user, 'status': old},
+                    'new_chat_member': {'user': user, 'status': new}}}
+
+def run_shard_worker(shard_index, shard_count, update_queue, fake_api):
+    """Entry point of a worker process: handle the updates of the chats in this shard."""
+    # The dispatcher decides when to stop and tells us with a None sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    bot = SecurityBot(shard_index, shard_count, request=FakeBotAPIRequest() if fake_api else None)
+    asyncio.run(bot.serve_queue(update_queue))
+
+class ShardedRuntime:
+    """Dispatcher that partitions incoming updates by chat_id across worker processes.
+
+    A chat always maps to the same worker and each worker handles its queue in order,
+    so per-chat ordering is preserved while different chats use different cores.
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT, source=UPDATE_SOURCE):
+        self.shard_count = shard_count
+        self.source = source
+        self.routed = [0] * shard_count
+    
+    def run(self):
+        logger.info("🧩 Starting %d shard worker(s), update source: %s", self.shard_count, self.source)
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(maxsize=10000) for _ in range(self.shard_count)]
+        workers = [
+            context.Process(target=run_shard_worker, name=f'shard-{i}',
+                            args=(i, self.shard_count, self.queues[i], self.source == 'fake'))
+            for i in range(self.shard_count)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            asyncio.run(self._dispatch())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for update_queue in self.queues:
+                update_queue.put(None)
+            for worker in workers:
+                worker.join()
+            logger.info("🧩 Routed updates per shard: %s", self.routed)
+    
+    async def route(self, data):
+        shard = shard_for_chat(update_chat_id(data), self.shard_count)
+        self.routed[shard] += 1
+        try:
+            self.queues[shard].put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(self.queues[shard].put, data)
+    
+    async def _dispatch(self):
+        if self.source == 'fake':
+            for data in FakeUpdateSource():
+                await self.route(data)
+            return
+        
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        
+        update_queue = asyncio.Queue()
+        updater = Updater(Bot(BOT_TOKEN), update_queue)
+        async with updater:
+            if WEBHOOK_URL:
+                await updater.start_webhook(
+                    listen=WEBHOOK_LISTEN,
+                    port=PORT,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            else:
+                await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info("Dispatcher is now running. Press Ctrl+C to stop.")
+            
+            stopped = loop.create_task(stop.wait())
+            while not stop.is_set():
+                fetched = loop.create_task(update_queue.get())
+                await asyncio.wait({fetched, stopped}, return_when=asyncio.FIRST_COMPLETED)
+                if not fetched.done():
+                    fetched.cancel()
+                    break
+                await self.route(fetched.result().to_dict())
+            await updater.stop()
 
 class SecurityBot:
-    def __init__(self):
-        self.application = Application.builder().token(BOT_TOKEN).build()
-        self.user_database = {}  # Store username -> user_info mapping
-        self.group_configs = {}  # Store group-specific configurations
-        self.config_file = 'group_configs.json'
+    def __init__(self, shard_index=0, shard_count=1, request=None):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        # Each shard gets an equal share of the global Bot API budget
+        self.rate_limiter = PriorityRateLimiter(global_rate=GLOBAL_RATE_LIMIT / shard_count)
+        builder = (
+            Application.builder()
+            .token(BOT_TOKEN or '0:offline')
+            .rate_limiter(self.rate_limiter)
+            .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+            .post_init(self.on_startup)
+            .post_stop(self.on_shutdown)  # Before Application.shutdown(), while the bot can still send
+        )
+        if request is not None:
+            builder = builder.request(request).get_updates_request(request)
+        self.application = builder.build()
+        self.db = SQLiteDatabase(shard_path(USER_DB_FILE, shard_index, shard_count))
+        self.user_store = UserStore(self.db)  # Index users by username, id and chat membership
+        self.admin_cache = TTLCache(ADMIN_CACHE_TTL)  # (chat_id, user_id) -> member status
+        self.bot_reads = BotReadCache()  # get_me / get_chat / member counts
+        self.greetings = GreetingBatcher(self.send_greeting)
+        self.catch_up = CatchUpBatcher(self.send_catch_up_summary)  # Backlog replayed after downtime
+        self.recent_joins = RecentJoins()
+        self.raid_detector = RaidDetector()
+        self.config_store = GroupConfigStore(self.db)  # Group-specific configurations
+        self.audit = AuditLog(self.db, shard_path(AUDIT_DIR, shard_index, shard_count))  # Moderation history
+        self.expirations = ExpiryScheduler(self.db, self.lift_expired)  # Timed bans and mutes
+        self.global_bans = GlobalBanList(SQLiteDatabase(GLOBAL_BAN_DB), GLOBAL_BAN_SNAPSHOT)  # Shared by all shards
+        self.global_bans.load()
+        self.global_ban_refresher = None
+        self.config_file = shard_path('group_configs.json', shard_index, shard_count)  # Legacy JSON, imported once
+        self.metrics_server = None
         self.load_group_configs()
         self.setup_handlers()
+        self.register_gauges()
     
     def load_group_configs(self):
-        """Load group configurations from file."""
+        """Import the legacy group_configs.json into the config store on first start."""
+        if self.config_store.migrated():
+            return  # Configs are read lazily from here on
+        others = sorted(set(existing_layouts()) - {self.shard_count})
+        if others:
+            # Starting fresh here would silently drop every group's data
+            raise RuntimeError(f"Data files of {others} shard(s) exist; run migrate_shard_layout({self.shard_count}) first")
         try:
             if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    self.group_configs = json.load(f)
-                print(f"✅ Loaded configurations for {len(self.group_configs)} groups")
+                imported, _ = self.config_store.import_json(self.config_file)
+                os.replace(self.config_file, f"{self.config_file}.migrated")
+                logger.info("✅ Moved %d group configurations from %s into %s", imported, self.config_file, self.db.path)
+            elif self.shard_count > 1 and os.path.exists('group_configs.json'):
+                # First sharded start: take this shard's slice of the unsharded file, which the other shards still need
+                imported, total = self.config_store.import_json(
+                    'group_configs.json', lambda chat_id: shard_for_chat(chat_id, self.shard_count) == self.shard_index)
+                logger.info("✅ Seeded shard %d with %d of %d groups", self.shard_index, imported, total)
             else:
-                print("📝 No existing config file found, starting fresh")
+                logger.info("📝 No existing config file found, starting fresh")
+            self.config_store.mark_migrated()
         except Exception as e:
-            print(f"❌ Error loading configs: {e}")
-            self.group_configs = {}
+            logger.error("❌ Error loading configs: %s", e)
+    
+    def save_group_config(self, chat_id, config):
+        """Mark a group's configuration changed; its overrides are written in the background."""
+        self.config_store.put(int(chat_id), config.maps[0])
+    
+    def register_gauges(self):
+        """Sizes that are read only when /metrics is scraped."""
+        METRICS.gauge('bot_users_cached', 'User profiles held in memory', lambda: len(self.user_store))
+        METRICS.gauge('bot_user_writes_pending', 'User and membership rows waiting to be written',
+                      lambda: self.user_store.pending_count)
+        METRICS.gauge('bot_group_configs_cached', 'Group configurations held in memory', lambda: len(self.config_store))
+        METRICS.gauge('bot_group_config_writes_pending', 'Group configurations waiting to be written',
+                      lambda: self.config_store.pending_count)
+        METRICS.gauge('bot_audit_writes_pending', 'Audit entries waiting to be appended', lambda: self.audit.pending_count)
+        METRICS.gauge('bot_outbound_queued', 'Bot API requests waiting in the rate limiter',
+                      lambda: {(('priority', str(lane)),): depth for lane, depth in enumerate(self.rate_limiter.stats()['queued'])})
+        METRICS.gauge('bot_global_bans', 'Users on the global ban list', lambda: len(self.global_bans))
+        METRICS.gauge('bot_expirations_loaded', 'Timed bans/mutes held in the in-memory heap', lambda: len(self.expirations))
+        METRICS.gauge('bot_busy_chats', 'Chats with an update being handled or waiting',
+                      self.application.update_processor.busy_chats)
+        METRICS.gauge('bot_greetings_pending', 'Names waiting in welcome/goodbye batches', self.greetings.pending)
+        METRICS.gauge('bot_catch_up_pending', 'Members in backlogs not yet summarized', self.catch_up.pending)
+    
+    async def on_startup(self, application: Application):
+        """Start the expiry timer and the metrics endpoint once the application is initialized."""
+        await self.expirations.start()
+        if self.shard_count > 1:
+            self.global_ban_refresher = asyncio.create_task(self.refresh_global_bans())
+        if METRICS_PORT:
+            port = METRICS_PORT + self.shard_index
+            self.metrics_server = await METRICS.serve(METRICS_HOST, port)
+            logger.info("📈 Metrics on http://%s:%d/metrics", METRICS_HOST, port)
+        if hasattr(signal, 'SIGUSR2'):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGUSR2, lambda: asyncio.create_task(self.profile_to_file(PROFILE_DEFAULT_SECONDS)))
     
-    def save_group_configs(self):
-        """Save group configurations to file."""
+    async def on_shutdown(self, application: Application):
+        """Send batched greetings and flush pending state before the bot shuts down."""
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.expirations.stop()
+        if self.global_ban_refresher is not None:
+            self.global_ban_refresher.cancel()
+        await self.greetings.flush()
+        await self.config_store.flush()
+        await self.audit.flush()
+        await self.user_store.flush()
+        self.db.close()
+        self.global_bans.close()
+    
+    async def profile_to_file(self, seconds):
+        """Profile for `seconds` and write the report to PROFILE_DIR (SIGUSR2)."""
+        logger.info("⏱️ Profiling for %ds", seconds)
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.group_configs, f, ensure_ascii=False, indent=2)
-            print(f"💾 Saved configurations for {len(self.group_configs)} groups")
-        except Exception as e:
-            print(f"❌ Error saving configs: {e}")
-    
-    def get_group_config(self, chat_id):
-        """Get configuration for a specific group."""
-        chat_id_str = str(chat_id)
-        if chat_id_str not in self.group_configs:
-            # Default configuration
-            self.group_configs[chat_id_str] = {
-                'welcome_message': """
-🎉 မင်္ဂလာပါ {user_name} 😊
-
-💰 Smile Coin Selling by Pyae မှ နွေးထွေးစွာ ကြိုဆိုပါတယ်! 
-🤗 စိတ်ချစွာ၀ယ်ယူနိုင်ပါတယ်
-
-👑 Admin - @PyaePPZ
-
-🇲🇲 Myanmar Time: {myanmar_time}
-                """.strip(),
-                'goodbye_message': """
-👋 {user_name} 
-😢 List ထဲမှာမင်းရှိတယ်ဆိုတာသိလိုက်ရတဲ့အချိန်ကစပြီးကိုယ်ဟာသအား၀မ်းနည်းနေပါပြီ 
-💔 ကောင်းရာဘ၀ကိုပိုင်ဆိုင်ရပါစေဗျာ
-
-🇲🇲 Myanmar Time: {myanmar_time}
+            report = await self.profiler.run(seconds)
+        except RuntimeError as e:
+            logger.warning("❌ %s", e)
+            return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(time.time())}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(report)
+        logger.info("⏱️ Profile written to %s", path)
+    
+    async def refresh_global_bans(self):
+        """Apply global bans added or lifted by other shards."""
+        while True:
+            await asyncio.sleep(GLOBAL_BAN_REFRESH)
+            try:
+                await self.global_bans.refresh()
+            except Exception:
+                logger.exception("🚨 Could not refresh the global ban list")
+    
+    async def get_group_config(self, chat_id):
+        """Get configuration for a specific group.
 
-😊 ကောင်းမွန်ပါစေ! Take care! 🌈
-                """.strip(),
-                'group_name': 'Default Group'
-            }
-            self.save_group_configs()
-        return self.group_configs[chat_id_str]
+        Reads fall back to GROUP_CONFIG_DEFAULTS and assignments land in the group's own
+        overrides; nothing is written unless save_group_config() is called.
+        """
+        return ChainMap(await self.config_store.get(int(chat_id)), GROUP_CONFIG_DEFAULTS)
     
     def setup_handlers(self):
         # Command handlers
@@ -102,23 +2563,46 @@ class SecurityBot:
         self.application.add_handler(CommandHandler("ban", self.ban_user))
         self.application.add_handler(CommandHandler("unban", self.unban_user))
         self.application.add_handler(CommandHandler("kick", self.kick_user))
+        self.application.add_handler(CommandHandler("tempban", self.tempban_user))
+        self.application.add_handler(CommandHandler("tempmute", self.tempmute_user))
+        self.application.add_handler(CommandHandler("unmute", self.unmute_user))
+        self.application.add_handler(CommandHandler("gban", self.global_ban_command))
+        self.application.add_handler(CommandHandler("ungban", self.global_unban_command))
+        self.application.add_handler(CommandHandler("globalbans", self.global_bans_setting))
         self.application.add_handler(CommandHandler("status", self.group_status))
         self.application.add_handler(CommandHandler("lookup", self.lookup_user))
+        self.application.add_handler(CommandHandler("modlog", self.show_modlog))
+        self.application.add_handler(CommandHandler("profile", self.profile_command))
         
         # New commands for group configuration
         self.application.add_handler(CommandHandler("setwelcome", self.set_welcome_message))
         self.application.add_handler(CommandHandler("setgoodbye", self.set_goodbye_message))
         self.application.add_handler(CommandHandler("setgroupname", self.set_group_name))
+        self.application.add_handler(CommandHandler("setgreetwindow", self.set_greeting_window))
+        self.application.add_handler(CommandHandler("setraid", self.set_raid_threshold))
+        self.application.add_handler(CommandHandler("lockdown", self.lockdown_command))
         self.application.add_handler(CommandHandler("showconfig", self.show_config))
         self.application.add_handler(CommandHandler("resetconfig", self.reset_config))
         
         # Chat member handler for tracking joins/leaves
         self.application.add_handler(ChatMemberHandler(self.track_chats, ChatMemberHandler.CHAT_MEMBER))
-        self.application.add_handler(ChatMemberHandler(self.track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
+        self.application.add_handler(ChatMemberHandler(self.track_bot_status, ChatMemberHandler.MY_CHAT_MEMBER))
         
         # Message handler to store user info
         from telegram.ext import MessageHandler, filters
         self.application.add_handler(MessageHandler(filters.ALL, self.store_user_info))
+        
+        # Time every handler for /metrics
+        for handlers in self.application.handlers.values():
+            for handler in handlers:
+                handler.callback = timed(handler.callback)
+        self.is_admin = timed(self.is_admin)
+        
+        # Handler frames the profiler charges samples and allocations to
+        callbacks = [handler.callback for handlers in self.application.handlers.values() for handler in handlers]
+        self.profiler = Profiler({
+            callback.__wrapped__.__code__: callback.__name__ for callback in callbacks + [self.is_admin]
+        })
     
     async def set_welcome_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Set custom welcome message for this group."""
@@ -148,13 +2632,20 @@ class SecurityBot:
         # Convert \n to actual line breaks
         new_message = new_message.replace('\\n', '\n')
         
-        config = self.get_group_config(chat_id)
+        # Validate once here so a bad template never reaches the join path
+        try:
+            template = MessageTemplate(new_message)
+        except TemplateError as e:
+            await update.message.reply_text(f"❌ Invalid welcome message: {e}")
+            return
+        
+        config = await self.get_group_config(chat_id)
         config['welcome_message'] = new_message
-        self.save_group_configs()
+        self.save_group_config(chat_id, config)
         
         await update.message.reply_text(
             f"✅ **Welcome message updated!**\n\n"
-            f"**Preview:**\n{new_message.format(user_name='[New Member]', myanmar_time=get_myanmar_time())}",
+            f"**Preview:**\n{template.render(user_name='[New Member]', myanmar_time=get_myanmar_time())}",
             parse_mode='Markdown'
         )
     
@@ -186,13 +2677,20 @@ class SecurityBot:
         # Convert \n to actual line breaks
         new_message = new_message.replace('\\n', '\n')
         
-        config = self.get_group_config(chat_id)
+        # Validate once here so a bad template never reaches the join path
+        try:
+            template = MessageTemplate(new_message)
+        except TemplateError as e:
+            await update.message.reply_text(f"❌ Invalid goodbye message: {e}")
+            return
+        
+        config = await self.get_group_config(chat_id)
         config['goodbye_message'] = new_message
-        self.save_group_configs()
+        self.save_group_config(chat_id, config)
         
         await update.message.reply_text(
             f"✅ **Goodbye message updated!**\n\n"
-            f"**Preview:**\n{new_message.format(user_name='[Leaving Member]', myanmar_time=get_myanmar_time())}",
+            f"**Preview:**\n{template.render(user_name='[Leaving Member]', myanmar_time=get_myanmar_time())}",
             parse_mode='Markdown'
         )
     
@@ -213,12 +2711,110 @@ class SecurityBot:
         chat_id = str(update.effective_chat.id)
         group_name = " ".join(context.args)
         
-        config = self.get_group_config(chat_id)
+        config = await self.get_group_config(chat_id)
         config['group_name'] = group_name
-        self.save_group_configs()
+        self.save_group_config(chat_id, config)
         
         await update.message.reply_text(f"✅ **Group name set to:** {group_name}")
     
+    async def set_greeting_window(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Set how joins/leaves are batched into welcome/goodbye messages."""
+        if not await self.is_admin(update, context):
+            await update.message.reply_text("❌ Only group administrators can use this command.")
+            return
+        
+        try:
+            window = int(context.args[0])
+            max_names = int(context.args[1]) if len(context.args) > 1 else None
+            if window < 0 or (max_names is not None and max_names < 1):
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text(
+                "❌ Please provide a window in seconds and optionally a name limit.\n\n"
+                "**Usage:** `/setgreetwindow 10 20`\n"
+                "Joins within 10 seconds share one welcome listing up to 20 names.\n"
+                "Use `0` to send one message per member.",
+                parse_mode='Markdown'
+            )
+            return
+        
+        config = await self.get_group_config(str(update.effective_chat.id))
+        config['greeting_window'] = window
+        if max_names is not None:
+            config['greeting_max_names'] = max_names
+        self.save_group_config(update.effective_chat.id, config)
+        
+        await update.message.reply_text(
+            f"✅ **Greeting batching updated!**\n"
+            f"⏱️ Window: {window}s\n"
+            f"👥 Names per message: {config['greeting_max_names']}",
+            parse_mode='Markdown'
+        )
+    
+    async def set_raid_threshold(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Set how many joins within the raid window put the group into lockdown."""
+        if not await self.is_admin(update, context):
+            await update.message.reply_text("❌ Only group administrators can use this command.")
+            return
+        
+        try:
+            threshold = int(context.args[0])
+            if threshold < 0:
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text(
+                "❌ Please provide a number of joins.\n\n"
+                "**Usage:** `/setraid 15`\n"
+                f"15 joins within {RAID_WINDOW} seconds start a lockdown.\n"
+                "Use `0` to turn raid detection off.",
+                parse_mode='Markdown'
+            )
+            return
+        
+        config = await self.get_group_config(str(update.effective_chat.id))
+        config['raid_threshold'] = threshold
+        self.save_group_config(update.effective_chat.id, config)
+        
+        await update.message.reply_text(
+            f"✅ **Raid detection updated!**\n"
+            + (f"🚨 Lockdown after {threshold} joins in {RAID_WINDOW}s" if threshold else "🚨 Raid detection is off"),
+            parse_mode='Markdown'
+        )
+    
+    async def lockdown_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show, start or lift a lockdown by hand."""
+        if not await self.is_admin(update, context):
+            await update.message.reply_text("❌ Only group administrators can use this command.")
+            return
+        
+        chat_id = update.effective_chat.id
+        mode = context.args[0].lower() if context.args else ''
+        released = 0
+        if mode == 'on':
+            self.raid_detector.lock(chat_id)
+            self.audit.record(chat_id, 'lockdown', actor=update.effective_user)
+            logger.warning("🚨 Lockdown started by %s", update.effective_user.full_name, extra=log_fields('lockdown', chat_id))
+        elif mode == 'off':
+            self.raid_detector.unlock(chat_id)
+            self.audit.record(chat_id, 'unlock', actor=update.effective_user)
+            released = await self.expirations.release_chat(chat_id, 'lockdown')
+            logger.info("🔓 Lockdown lifted by %s, unmuting %d member(s)", update.effective_user.full_name, released,
+                        extra=log_fields('lockdown', chat_id))
+        elif mode:
+            await update.message.reply_text("❌ Usage: `/lockdown on`, `/lockdown off` or `/lockdown`", parse_mode='Markdown')
+            return
+        
+        remaining = self.raid_detector.locked_for(chat_id)
+        joins = self.raid_detector.joins(chat_id)
+        if remaining:
+            text = (f"🔒 **Lockdown active** for {int(remaining // 60) + 1} more minute(s)\n"
+                    "New members are muted and welcomes are paused.")
+        else:
+            text = "🔓 **No lockdown** - new members join normally."
+            if released:
+                text += f"\n🔊 Unmuting {released} member(s) muted during the lockdown."
+        await update.message.reply_text(f"{text}\n👥 Joins in the last {RAID_WINDOW}s: {joins}", parse_mode='Markdown')
+    
     async def show_config(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show current group configuration."""
         if not await self.is_admin(update, context):
@@ -226,13 +2822,16 @@ class SecurityBot:
             return
         
         chat_id = str(update.effective_chat.id)
-        config = self.get_group_config(chat_id)
+        config = await self.get_group_config(chat_id)
         
         config_message = f"""
 📋 **Current Group Configuration**
 
 🏷️ **Group Name:** {config['group_name']}
 🆔 **Chat ID:** `{chat_id}`
+⏱️ **Greeting Window:** {config['greeting_window']}s (max {config['greeting_max_names']} names)
+🚨 **Raid Lockdown:** {f"{config['raid_threshold']} joins in {RAID_WINDOW}s" if config['raid_threshold'] else 'off'}
+🌐 **Global Ban List:** {'on' if config['global_bans'] else 'off'}
 
 🎉 **Welcome Message:**
 ```
@@ -244,6 +2843,7 @@ class SecurityBot:
 {config['goodbye_message']}
 ```
 
+✏️ **Customized:** {', '.join(f'`{key}`' for key in sorted(config.maps[0])) or f'nothing (defaults v{GROUP_CONFIG_DEFAULTS_VERSION})'}
 📝 **Note:** Use placeholders `{{user_name}}` and `{{myanmar_time}}` in your messages.
 
 🇲🇲 Myanmar Time: {get_myanmar_time()}
@@ -259,12 +2859,8 @@ class SecurityBot:
         
         chat_id = str(update.effective_chat.id)
         
-        # Remove existing config to trigger default creation
-        if chat_id in self.group_configs:
-            del self.group_configs[chat_id]
-        
-        # Get default config
-        self.get_group_config(chat_id)
+        # Drop every override so the group follows the shared defaults again
+        self.save_group_config(chat_id, ChainMap({}, GROUP_CONFIG_DEFAULTS))
         
         await update.message.reply_text("✅ **Group configuration reset to default!**\n\nUse `/showconfig` to see current settings.")
     
@@ -279,13 +2875,23 @@ I'm now monitoring this group for member changes and providing admin controls.
 • `/ban @username` - Ban a user from the group
 • `/unban @username` - Unban a user
 • `/kick @username` - Kick a user (they can rejoin)
+• `/tempban 1d @username` - Ban for a while (s/m/h/d/w, e.g. `30m`, `1d12h`)
+• `/tempmute 2h @username` - Mute for a while
+• `/unmute @username` - Lift a mute
+• `/globalbans on` - Ban users on the global ban list when they join
+  (each takes several @usernames or `id:123456789`, or `joined:10` for everyone who joined in the last 10 minutes;
+  the rest is the reason; a number after a target is only taken as an ID if I have seen that user)
 • `/status` - Show group statistics
+• `/modlog [@username] [count]` - Recent moderation actions
 • `/help` - Show this help message
 
 **Group Configuration:**
 • `/setwelcome` - Set custom welcome message
 • `/setgoodbye` - Set custom goodbye message
 • `/setgroupname` - Set group name
+• `/setgreetwindow` - Batch welcome/goodbye messages
+• `/setraid` - Joins per minute that trigger a lockdown
+• `/lockdown on|off` - Start or lift a lockdown by hand
 • `/showconfig` - Show current config
 • `/resetconfig` - Reset to default
 
@@ -302,7 +2908,7 @@ Only group admins can use moderation commands.
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send help message."""
-        config = self.get_group_config(str(update.effective_chat.id))
+        config = await self.get_group_config(str(update.effective_chat.id))
         
         help_text = f"""🔒 <b>Security Bot - {config['group_name']}</b>
 
@@ -332,289 +2938,495 @@ Only group admins can use moderation commands.
         """
         await update.message.reply_text(help_text, parse_mode='HTML')
     
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Profile the bot for a few seconds and send the report as a file; bot admins only."""
+        if not is_bot_admin(update.effective_user):
+            await update.message.reply_text("❌ Only bot administrators can use this command.")
+            return
+        
+        try:
+            seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+            if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text(f"❌ Usage: `/profile [seconds]` (1-{PROFILE_MAX_SECONDS})", parse_mode='Markdown')
+            return
+        if self.profiler.running:
+            await update.message.reply_text("⏳ A profile is already running, try again when it is done.")
+            return
+        
+        await update.message.reply_text(f"⏱️ Profiling for {seconds}s...")
+        
+        async def profile_and_send():
+            report = await self.profiler.run(seconds)
+            await update.message.reply_document(
+                report.encode('utf-8'),
+                filename=f"profile-{os.getpid()}-{int(time.time())}.txt",
+                caption=f"⏱️ {seconds}s CPU and memory profile\n🇲🇲 Myanmar Time: {get_myanmar_time()}"
+            )
+        
+        # In the background, so this chat's other updates are not held up meanwhile
+        context.application.create_task(profile_and_send(), update=update)
+    
     async def is_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
         """Check if user is admin of the group or in admin list."""
         user_id = update.effective_user.id
-        username = update.effective_user.username
         chat_id = update.effective_chat.id
         
         # Check if user is in predefined admin list
-        if user_id in ADMIN_USER_IDS or (username and username in ADMIN_USERNAMES):
+        if is_bot_admin(update.effective_user):
             return True
         
         try:
-            member = await context.bot.get_chat_member(chat_id, user_id)
-            # Fixed: Use OWNER instead of CREATOR for older versions
-            admin_statuses = [ChatMemberStatus.ADMINISTRATOR]
-            # Try both CREATOR and OWNER to be compatible with different versions
-            try:
-                admin_statuses.append(ChatMemberStatus.CREATOR)
-            except AttributeError:
-                pass
-            try:
-                admin_statuses.append(ChatMemberStatus.OWNER)
-            except AttributeError:
-                pass
-            
-            return member.status in admin_statuses
+            return await self.get_member_status(context, chat_id, user_id) in ADMIN_STATUSES
         except Exception as e:
             logger.error(f"Error checking admin status: {e}")
             return False
     
+    async def get_member_status(self, context: ContextTypes.DEFAULT_TYPE, chat_id, user_id):
+        """Return a user's status in a chat, served from the admin cache when possible."""
+        async def fetch():
+            member = await context.bot.get_chat_member(chat_id, user_id)
+            return member.status
+        return await self.admin_cache.get((chat_id, user_id), fetch)
+    
+    async def moderation_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text, **kwargs):
+        """Reply to a moderation command in the top-priority outbound lane."""
+        message = update.message
+        return await context.bot.send_message(
+            message.chat_id,
+            text,
+            reply_to_message_id=message.message_id,
+            message_thread_id=message.message_thread_id if message.is_topic_message else None,
+            rate_limit_args={'priority': PRIORITY_MODERATION},
+            **kwargs
+        )
+    
     async def store_user_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Store user information from messages for later username-based actions."""
+        """Store user information from messages for later username- and id-based actions."""
         if update.message and update.message.from_user:
             user = update.message.from_user
-            if user.username:  # Only store if user has a username
-                self.user_database[user.username.lower()] = {
-                    'id': user.id,
-                    'full_name': user.full_name,
-                    'username': user.username,
-                    'chat_id': update.effective_chat.id
-                }
-                print(f"💾 Stored info for @{user.username} (ID: {user.id}) - {get_myanmar_time()}")
+            self.user_store.observe(user, update.effective_chat.id)
+            # One line per message is too much even at DEBUG, keep a sample
+            if logger.isEnabledFor(logging.DEBUG) and sampled('store_user_info'):
+                logger.debug("💾 Stored info for @%s", user.username,
+                             extra=log_fields('store_user_info', update.effective_chat.id, user.id))
     
     async def lookup_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Look up a user's information by username."""
+        """Look up a user's information by username or ID."""
         if not await self.is_admin(update, context):
             await update.message.reply_text("❌ Only group administrators can use this command.")
             return
         
         if not context.args:
-            await update.message.reply_text("❌ Please specify a username.\nUsage: `/lookup @username`", parse_mode='Markdown')
+            await update.message.reply_text("❌ Please specify a username or ID.\nUsage: `/lookup @username` or `/lookup 123456789`", parse_mode='Markdown')
             return
         
-        username = context.args[0].replace('@', '').lower()
+        target = context.args[0]
         
-        if username in self.user_database:
-            user_info = self.user_database[username]
+        user_info = await self.user_store.resolve(target)
+        if user_info:
+            ban_target = f"@{user_info.username}" if user_info.username else user_info.id
+            status_here = user_info.chats.get(update.effective_chat.id, 'unknown')
             lookup_message = f"""
 👤 **User Found**
-🏷️ Name: {user_info['full_name']}
-👤 Username: @{user_info['username']}
-🆔 ID: `{user_info['id']}`
-📝 To ban: `/ban @{user_info['username']}`
+🏷️ Name: {user_info.full_name}
+👤 Username: @{user_info.username or 'No username'}
+🆔 ID: `{user_info.id}`
+👥 Seen in groups: {len(user_info.chats)}
+📍 Status here: {status_here}
+📝 To ban: `/ban {ban_target}`
 🕐 Myanmar Time: {get_myanmar_time()}
             """
             await update.message.reply_text(lookup_message, parse_mode='Markdown')
         else:
-            await update.message.reply_text(f"❌ User @{username} not found in database.\nThey need to send a message first for me to store their info.")
+            await update.message.reply_text(f"❌ User {target} not found in database.\nThey need to send a message first for me to store their info.")
     
-    async def ban_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Ban a user from the group."""
+    def _is_target_token(self, token):
+        return ((token.startswith('@') and len(token) > 1) or parse_id_marker(token) is not None
+                or parse_joined_selector(token) is not None)
+    
+    async def resolve_targets(self, update: Update, context: ContextTypes.DEFAULT_TYPE, args=None):
+        """Collect moderation targets from the command.
+
+        Targets are the author of the replied-to message plus any leading @usernames,
+        ``id:<user id>`` markers and ``joined:<minutes>`` selectors (everyone who joined
+        in the last N minutes). A bare number is a user ID when it comes first; after
+        another target it counts only if the user index knows that ID, otherwise it
+        starts the reason, so ``/ban @spammer 100 spam messages`` bans one user. The
+        remaining words are the reason. Returns (targets, unknown, reason) where unknown
+        lists usernames missing from the user index.
+        """
+        chat_id = update.effective_chat.id
+        targets = {}  # user_id -> object with id/full_name/username, in command order
+        message = update.message
+        if message.reply_to_message and message.reply_to_message.from_user:
+            user = message.reply_to_message.from_user
+            targets[user.id] = user
+        
+        args = list(context.args or [] if args is None else args)
+        tokens = []
+        while args:
+            if args[0].isdigit():
+                if (tokens or targets) and await self.user_store.get_by_id(int(args[0])) is None:
+                    break
+            elif not self._is_target_token(args[0]):
+                break
+            tokens.append(args.pop(0))
+        reason = " ".join(args) or None
+        
+        lookups = [token for token in tokens if token.startswith('@')]
+        records = dict(zip(lookups, await asyncio.gather(*(self.user_store.resolve(t) for t in lookups))))
+        unknown = []
+        for token in tokens:
+            minutes = parse_joined_selector(token)
+            user_id = int(token) if token.isdigit() else parse_id_marker(token)
+            if minutes is not None:
+                for user in self.recent_joins.since(chat_id, minutes * 60):
+                    targets.setdefault(user.id, user)
+            elif user_id is not None:
+                # We can act on an ID we have never seen, there is just no name to show
+                targets.setdefault(user_id, await self.user_store.get_by_id(user_id) or placeholder_user(user_id))
+            elif records[token] is not None:
+                targets.setdefault(records[token].id, records[token])
+            else:
+                unknown.append(token)
+        return list(targets.values()), unknown, reason
+    
+    async def moderation_precheck(self, context: ContextTypes.DEFAULT_TYPE, chat_id, actor_id, bot_id, action, target):
+        """Return why target must not be banned/kicked, or None if it may be."""
+        if is_bot_admin(target):
+            return f"Cannot {action} a bot administrator!"
+        if target.id == actor_id:
+            return f"You cannot {action} yourself!"
+        if target.id == bot_id:
+            return f"I cannot {action} myself! 🤖"
+        try:
+            if await self.get_member_status(context, chat_id, target.id) in ADMIN_STATUSES:
+                return f"Cannot {action} a group administrator."
+        except Exception:
+            pass  # User might not be in group, continue
+        return None
+    
+    async def apply_moderation(self, bot, chat_id, action, user_id):
+        if action == 'ban':
+            await bot.ban_chat_member(chat_id, user_id)
+        elif action == 'kick':
+            # Kick user (ban then unban to allow rejoining)
+            await bot.ban_chat_member(chat_id, user_id)
+            await bot.unban_chat_member(chat_id, user_id)
+        elif action == 'mute':
+            await bot.restrict_chat_member(chat_id, user_id, ChatPermissions.no_permissions())
+        elif action == 'unmute':
+            await self.unmute_member(bot, chat_id, user_id)
+        else:
+            await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+    
+    async def unmute_member(self, bot, chat_id, user_id, **kwargs):
+        """Give a muted member the group's default permissions back."""
+        chat = await self.bot_reads.get_chat(bot, chat_id)
+        permissions = chat.permissions or ChatPermissions.all_permissions()
+        await bot.restrict_chat_member(chat_id, user_id, permissions, **kwargs)
+    
+    async def lift_expired(self, chat_id, user_id, action):
+        """End a timed ban or mute; called by the expiry scheduler."""
+        bot = self.application.bot
+        # Behind manual moderation in the outbound queue, ahead of greetings
+        rate_limit_args = {'priority': PRIORITY_COMMAND}
+        if action == 'ban':
+            await bot.unban_chat_member(chat_id, user_id, only_if_banned=True, rate_limit_args=rate_limit_args)
+            released = 'unban'
+        else:
+            # 'mute' from /tempmute, 'lockdown' for members muted by a lockdown
+            await self.unmute_member(bot, chat_id, user_id, rate_limit_args=rate_limit_args)
+            released = 'unmute'
+        user = await self.user_store.get_by_id(user_id) or placeholder_user(user_id)
+        reason = 'Lockdown ended' if action == 'lockdown' else f'Timed {action} expired'
+        self.audit.record(chat_id, released, user, reason=reason, auto=True)
+        logger.info("⏰ Timed %s expired", action, extra=log_fields('expirations', chat_id, user_id))
+    
+    async def moderate(self, update: Update, context: ContextTypes.DEFAULT_TYPE, action, duration=None):
+        """Run a moderation command against one or many targets and send a single reply.
+
+        With a duration (seconds) the ban or mute is lifted again by the expiry scheduler.
+        """
         if not await self.is_admin(update, context):
-            await update.message.reply_text("❌ Only group administrators can use this command.")
+            await self.moderation_reply(update, context, "❌ Only group administrators can use this command.")
             return
         
-        target_user = None
-        target_user_id = None
-        reason = None
+        command = f"temp{action} 1h" if duration else action
+        args = context.args[1:] if duration else context.args
+        targets, unknown, reason = await self.resolve_targets(update, context, args)
+        if not targets and not unknown:
+            await self.moderation_reply(update, context, 
+                f"❌ Please specify who to {action}.\n"
+                f"Usage: `/{command} @username id:123456789 ... [reason]`, `/{command} joined:10` "
+                f"(everyone who joined in the last 10 minutes) or reply to a message with `/{command}`\n"
+                "After another target, write IDs of users I have not seen as `id:123456789`, "
+                "so a reason may start with a number.",
+                parse_mode='Markdown'
+            )
+            return
         
-        # Check if replying to a message
-        if update.message.reply_to_message:
-            target_user = update.message.reply_to_message.from_user
-            target_user_id = target_user.id
-            reason = " ".join(context.args) if context.args else None
-        else:
-            # Parse arguments
-            if not context.args:
-                await update.message.reply_text("❌ Please specify a username to ban.\nUsage: `/ban @username` or reply to a message with `/ban`", parse_mode='Markdown')
-                return
-            
-            username_arg = context.args[0]
-            reason = " ".join(context.args[1:]) if len(context.args) > 1 else None
-            
-            # Only accept usernames (must start with @)
-            if not username_arg.startswith('@'):
-                await update.message.reply_text("❌ Please provide a username starting with @\nUsage: `/ban @username`", parse_mode='Markdown')
-                return
-            
-            # Remove @ symbol and convert to lowercase
-            username = username_arg[1:].lower()
-            
-            # Check if trying to ban predefined admins by username
-            if username in [admin.lower() for admin in ADMIN_USERNAMES]:
-                await update.message.reply_text("❌ Cannot ban a bot administrator!")
-                return
-            
-            # Look up user in database
-            if username in self.user_database:
-                user_info = self.user_database[username]
-                target_user_id = user_info['id']
-                # Create a user object for display
-                target_user = type('User', (), {
-                    'id': user_info['id'],
-                    'full_name': user_info['full_name'],
-                    'username': user_info['username']
-                })()
-                print(f"🎯 Found @{username} in database - ID: {target_user_id}")
-            else:
-                await update.message.reply_text(
-                    f"❌ Cannot find @{username} in my database.\n\n"
-                    "**This user needs to:**\n"
-                    "1. Send at least one message in this group\n"
-                    "2. Then you can ban them with `/ban @{username}`\n\n"
-                    "**Alternative:**\n"
-                    "• Reply to their message with `/ban`\n"
-                    "• Use `/lookup @{username}` to check if they're stored",
-                    parse_mode='Markdown'
-                )
-                return
+        if len(targets) + len(unknown) == 1 and unknown:
+            username = unknown[0].lstrip('@')
+            await self.moderation_reply(update, context, 
+                f"❌ Cannot find @{username} in my database.\n\n"
+                "**This user needs to:**\n"
+                "1. Send at least one message in this group\n"
+                f"2. Then you can {action} them with `/{command} @{username}`\n\n"
+                "**Alternative:**\n"
+                f"• Reply to their message with `/{command}`\n"
+                f"• Use `/lookup @{username}` to check if they're stored",
+                parse_mode='Markdown'
+            )
+            return
         
-        if target_user_id:
-            # Check if trying to ban an admin (including predefined admins)
-            if target_user_id in ADMIN_USER_IDS:
-                await update.message.reply_text("❌ Cannot ban a bot administrator!")
-                return
-            
-            if target_user and target_user.username and target_user.username.lower() in [admin.lower() for admin in ADMIN_USERNAMES]:
-                await update.message.reply_text("❌ Cannot ban a bot administrator!")
-                return
-            
-            # Check if trying to ban self
-            if target_user_id == update.effective_user.id:
-                await update.message.reply_text("❌ You cannot ban yourself!")
-                return
-            
-            # Check if trying to ban a group admin
-            try:
-                member = await context.bot.get_chat_member(update.effective_chat.id, target_user_id)
-                admin_statuses = [ChatMemberStatus.ADMINISTRATOR]
-                # Try both CREATOR and OWNER to be compatible with different versions
-                try:
-                    admin_statuses.append(ChatMemberStatus.CREATOR)
-                except AttributeError:
-                    pass
+        chat_id = update.effective_chat.id
+        actor = update.effective_user
+        # Shared pre-checks: resolved once for the whole batch
+        bot_id = (await self.bot_reads.get_me(context.bot)).id if action not in RELEASE_ACTIONS else None
+        until = time.time() + duration if duration else None
+        semaphore = asyncio.Semaphore(MODERATION_CONCURRENCY)
+        
+        async def run_one(target):
+            async with semaphore:
+                if action not in RELEASE_ACTIONS:
+                    refusal = await self.moderation_precheck(context, chat_id, actor.id, bot_id, action, target)
+                    if refusal:
+                        return target, 'skipped', refusal
                 try:
-                    admin_statuses.append(ChatMemberStatus.OWNER)
-                except AttributeError:
-                    pass
-                
-                if member.status in admin_statuses:
-                    await update.message.reply_text("❌ Cannot ban a group administrator.")
-                    return
-            except Exception:
-                pass  # User might not be in group, continue with ban
-            
-            # Check if trying to ban the bot itself
-            bot_info = await context.bot.get_me()
-            if target_user_id == bot_info.id:
-                await update.message.reply_text("❌ I cannot ban myself! 🤖")
-                return
-                
-            try:
-                await context.bot.ban_chat_member(update.effective_chat.id, target_user_id)
-                
-                ban_message = f"""
-🚫 **User Banned**
-👤 User: {target_user.full_name} (@{target_user.username or 'No username'})
-🆔 ID: `{target_user_id}`
-👮 Banned by: {update.effective_user.full_name}"""
-
-                if reason:
-                    ban_message += f"\n📝 Reason: {reason}"
-                
-                ban_message += f"\n🇲🇲 Myanmar Time: {get_myanmar_time()}"
-                
-                await update.message.reply_text(ban_message, parse_mode='Markdown')
-                print(f"✅ Successfully banned @{target_user.username} (ID: {target_user_id}) - {get_myanmar_time()}")
-                
-            except Exception as e:
-                await update.message.reply_text(f"❌ Failed to ban user: {str(e)}")
-                print(f"❌ Ban failed: {e}")
+                    await self.apply_moderation(context.bot, chat_id, action, target.id)
+                except Exception as e:
+                    logger.warning("❌ %s failed: %s", action.title(), e, extra=log_fields(f'{action}_user', chat_id, target.id))
+                    return target, 'failed', str(e)
+                logger.info("✅ %s @%s (ID: %s)", MODERATION_PAST_TENSE[action], target.username, target.id,
+                            extra=log_fields(f'{action}_user', chat_id, target.id))
+                self.audit.record(chat_id, action, target, actor, reason, until=until)
+                for ended in ENDED_EXPIRATIONS.get(action, ()):
+                    if not (until and ended == action):  # A new timed action replaces its own schedule
+                        await self.expirations.cancel(chat_id, target.id, ended)
+                if until:
+                    await self.expirations.schedule(chat_id, target.id, action, until)
+                return target, 'done', None
+        
+        results = await asyncio.gather(*(run_one(target) for target in targets))
+        
+        if len(results) == 1 and not unknown:
+            target, outcome, detail = results[0]
+            if outcome == 'skipped':
+                await self.moderation_reply(update, context, f"❌ {detail}")
+            elif outcome == 'failed':
+                await self.moderation_reply(update, context, f"❌ Failed to {action} user: {detail}")
+            else:
+                await self.moderation_reply(update, context, self.format_moderation_message(action, target, actor, reason, until), parse_mode='Markdown')
+            return
+        
+        await self.moderation_reply(update, context, self.format_moderation_summary(action, results, unknown, actor, reason, until))
+    
+    def format_moderation_message(self, action, target, actor, reason, until=None):
+        icon, title = MODERATION_TITLES[action]
+        if action in RELEASE_ACTIONS:
+            message = f"""
+{icon} **User {title}**
+🆔 User ID: `{target.id}`
+👮 {title} by: {actor.full_name}"""
         else:
-            await update.message.reply_text("❌ Could not identify the user to ban.")
+            message = f"""
+{icon} **User {title}**
+👤 User: {target.full_name} (@{target.username or 'No username'})
+🆔 ID: `{target.id}`
+👮 {title} by: {actor.full_name}"""
+        
+        if reason:
+            message += f"\n📝 Reason: {reason}"
+        if until:
+            message += f"\n⏳ Until: {format_until(until)}"
+        
+        message += f"\n🇲🇲 Myanmar Time: {get_myanmar_time()}"
+        return message
+    
+    def format_moderation_summary(self, action, results, unknown, actor, reason, until=None):
+        """One plain-text reply for a bulk command (names may contain Markdown characters)."""
+        icon, title = MODERATION_TITLES[action]
+        done = sum(1 for _, outcome, _ in results if outcome == 'done')
+        problems = [
+            f"• {target.full_name} ({target.id}) - {detail}"
+            for target, outcome, detail in results if outcome != 'done'
+        ] + [f"• {token} - not in my database" for token in unknown]
+        
+        lines = [
+            f"{icon} Bulk {action} finished",
+            f"✅ {title}: {done}/{len(results) + len(unknown)}",
+            f"👮 By: {actor.full_name}",
+        ]
+        if reason:
+            lines.append(f"📝 Reason: {reason}")
+        if until:
+            lines.append(f"⏳ Until: {format_until(until)}")
+        lines.append(f"🇲🇲 Myanmar Time: {get_myanmar_time()}")
+        if problems:
+            lines.append("")
+            lines.append(f"⚠️ Not {title.lower()} ({len(problems)}):")
+            lines.extend(problems[:MODERATION_SUMMARY_LINES])
+            if len(problems) > MODERATION_SUMMARY_LINES:
+                lines.append(f"… and {len(problems) - MODERATION_SUMMARY_LINES} more")
+        return "\n".join(lines)
+    
+    async def ban_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ban one or more users from the group."""
+        await self.moderate(update, context, 'ban')
     
     async def unban_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Unban a user from the group."""
+        """Unban one or more users from the group."""
+        await self.moderate(update, context, 'unban')
+    
+    async def kick_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Kick one or more users from the group."""
+        await self.moderate(update, context, 'kick')
+    
+    async def timed_moderation(self, update: Update, context: ContextTypes.DEFAULT_TYPE, action):
+        duration = parse_duration(context.args[0]) if context.args else None
+        if duration is None:
+            await self.moderation_reply(update, context,
+                f"❌ Please start with a duration.\n"
+                f"Usage: `/temp{action} 30m @username ...` (units: s, m, h, d, w - e.g. `1d12h`)",
+                parse_mode='Markdown'
+            )
+            return
+        await self.moderate(update, context, action, duration)
+    
+    async def tempban_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ban one or more users for a limited time."""
+        await self.timed_moderation(update, context, 'ban')
+    
+    async def tempmute_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Mute one or more users for a limited time."""
+        await self.timed_moderation(update, context, 'mute')
+    
+    async def unmute_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Lift a mute from one or more users."""
+        await self.moderate(update, context, 'unmute')
+    
+    async def update_global_bans(self, update: Update, context: ContextTypes.DEFAULT_TYPE, action):
+        """Add users to ('gban') or remove them from ('ungban') the global ban list; bot admins only."""
+        actor = update.effective_user
+        if not is_bot_admin(actor):
+            await self.moderation_reply(update, context, "❌ Only bot administrators can change the global ban list.")
+            return
+        
+        targets, unknown, reason = await self.resolve_targets(update, context)
+        not_found = f"\n❓ Not found: {', '.join(unknown)}" if unknown else ''  # Tokens keep their '@'
+        if not targets:
+            await self.moderation_reply(update, context,
+                f"❌ Please specify who to {'add to' if action == 'gban' else 'remove from'} the global ban list.\n"
+                f"Usage: `/{action} @username id:123456789 ...` or reply to a message with `/{action}`"
+                + not_found,
+                parse_mode='Markdown'
+            )
+            return
+        
+        user_ids = [target.id for target in targets]
+        if action == 'gban':
+            changed = await self.global_bans.add(user_ids, actor.id, reason)
+            message = f"🌐 Added {changed} user(s) to the global ban list"
+            if changed < len(user_ids):
+                message += f" ({len(user_ids) - changed} already listed)"
+        else:
+            changed = await self.global_bans.remove(user_ids, actor.id)
+            message = f"🌐 Removed {changed} user(s) from the global ban list"
+            if changed < len(user_ids):
+                message += f" ({len(user_ids) - changed} not listed)"
+        for target in targets:
+            self.audit.record(update.effective_chat.id, action, target, actor, reason)
+        
+        message += f"\n📋 Listed users: {len(self.global_bans)}" + not_found
+        if action == 'gban':
+            message += "\nℹ️ Groups that turned on /globalbans ban them when they join."
+        await self.moderation_reply(update, context, message)
+    
+    async def global_ban_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Put users on the global ban list."""
+        await self.update_global_bans(update, context, 'gban')
+    
+    async def global_unban_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Take users off the global ban list."""
+        await self.update_global_bans(update, context, 'ungban')
+    
+    async def global_bans_setting(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show or change whether this group bans users on the global ban list."""
         if not await self.is_admin(update, context):
             await update.message.reply_text("❌ Only group administrators can use this command.")
             return
         
-        if not context.args:
-            await update.message.reply_text("❌ Please specify a user ID to unban.\nUsage: `/unban 123456789`", parse_mode='Markdown')
+        config = await self.get_group_config(str(update.effective_chat.id))
+        mode = context.args[0].lower() if context.args else ''
+        if mode in ('on', 'off'):
+            config['global_bans'] = mode == 'on'
+            self.save_group_config(update.effective_chat.id, config)
+        elif mode:
+            await update.message.reply_text("❌ Usage: `/globalbans on` or `/globalbans off`", parse_mode='Markdown')
             return
         
-        try:
-            user_id = int(context.args[0])
-            await context.bot.unban_chat_member(update.effective_chat.id, user_id)
-            
-            unban_message = f"""
-✅ **User Unbanned**
-🆔 User ID: `{user_id}`
-👮 Unbanned by: {update.effective_user.full_name}
-🇲🇲 Myanmar Time: {get_myanmar_time()}
-            """
-            await update.message.reply_text(unban_message, parse_mode='Markdown')
-            
-        except ValueError:
-            await update.message.reply_text("❌ Please provide a valid user ID.")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Failed to unban user: {str(e)}")
+        state = "on ✅" if config['global_bans'] else "off"
+        await update.message.reply_text(
+            f"🌐 **Global ban list:** {state}\n"
+            f"📋 Listed users: {len(self.global_bans)}\n"
+            "When on, listed users are banned as soon as they join.",
+            parse_mode='Markdown'
+        )
     
-    async def kick_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Kick a user from the group."""
+    async def show_modlog(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show recent moderation actions in this group, optionally for one user."""
         if not await self.is_admin(update, context):
             await update.message.reply_text("❌ Only group administrators can use this command.")
             return
         
-        target_user = None
-        reason = None
+        args = list(context.args or [])
+        count = MODLOG_DEFAULT_ENTRIES
+        # A lone small number is a count; user IDs are far larger
+        if args and args[-1].isdigit() and (len(args) == 2 or int(args[-1]) <= MODLOG_MAX_ENTRIES):
+            count = max(min(int(args.pop()), MODLOG_MAX_ENTRIES), 1)
+        user_id = None
+        if args:
+            if args[0].lstrip('-').isdigit():
+                user_id = int(args[0])
+            else:
+                record = await self.user_store.resolve(args[0])
+                if record is None:
+                    await update.message.reply_text(f"❌ Cannot find {args[0]} in my database.")
+                    return
+                user_id = record.id
         
-        # Check if replying to a message
-        if update.message.reply_to_message:
-            target_user = update.message.reply_to_message.from_user
-            reason = " ".join(context.args) if context.args else None
-        else:
-            if not context.args:
-                await update.message.reply_text("❌ Please specify a user to kick.\nUsage: `/kick user_id` or reply to a message with `/kick`", parse_mode='Markdown')
-                return
-            
-            try:
-                user_id = int(context.args[0])
-                # Try to get user info
-                try:
-                    chat_member = await context.bot.get_chat_member(update.effective_chat.id, user_id)
-                    target_user = chat_member.user
-                except Exception:
-                    target_user = type('User', (), {
-                        'id': user_id,
-                        'full_name': f'User {user_id}',
-                        'username': None
-                    })()
-                reason = " ".join(context.args[1:]) if len(context.args) > 1 else None
-            except ValueError:
-                await update.message.reply_text("❌ Please provide a valid user ID or reply to a message.")
-                return
+        entries = await self.audit.query(chat_id=update.effective_chat.id, user_id=user_id, limit=count)
+        if not entries:
+            await update.message.reply_text("📜 No moderation actions recorded here yet.")
+            return
         
-        if target_user:
-            try:
-                # Kick user (ban then unban to allow rejoining)
-                await context.bot.ban_chat_member(update.effective_chat.id, target_user.id)
-                await context.bot.unban_chat_member(update.effective_chat.id, target_user.id)
-                
-                kick_message = f"""
-👢 **User Kicked**
-👤 User: {target_user.full_name} (@{target_user.username or 'No username'})
-🆔 ID: `{target_user.id}`
-👮 Kicked by: {update.effective_user.full_name}"""
-
-                if reason:
-                    kick_message += f"\n📝 Reason: {reason}"
-                
-                kick_message += f"\n🇲🇲 Myanmar Time: {get_myanmar_time()}"
-                
-                await update.message.reply_text(kick_message, parse_mode='Markdown')
-                
-            except Exception as e:
-                await update.message.reply_text(f"❌ Failed to kick user: {str(e)}")
+        lines = [f"📜 Last {len(entries)} moderation action(s)"]
+        for entry in entries:
+            when = datetime.fromtimestamp(entry['ts'], MYANMAR_TZ).strftime('%Y-%m-%d %H:%M')
+            line = f"{AUDIT_ICONS.get(entry['action'], '•')} {when} {entry['action']}"
+            if 'user_id' in entry:
+                line += f" {entry['user_name']} ({entry['user_id']})"
+            line += f" by {entry['actor_name']}" if 'actor_id' in entry else " (automatic)"
+            if entry.get('until'):
+                line += f" until {format_until(entry['until'])}"
+            if entry.get('reason'):
+                line += f" - {entry['reason']}"
+            lines.append(line)
+        # Plain text: names and reasons may contain Markdown characters
+        await update.message.reply_text("\n".join(lines))
     
     async def group_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show group statistics."""
         try:
-            chat = await context.bot.get_chat(update.effective_chat.id)
-            member_count = await context.bot.get_chat_member_count(update.effective_chat.id)
-            config = self.get_group_config(str(update.effective_chat.id))
+            chat, member_count = await asyncio.gather(
+                self.bot_reads.get_chat(context.bot, update.effective_chat.id),
+                self.bot_reads.get_chat_member_count(context.bot, update.effective_chat.id),
+            )
+            config = await self.get_group_config(str(update.effective_chat.id))
+            outbound = self.rate_limiter.stats()
             
             status_message = f"""
 📊 **Group Status**
@@ -628,138 +3440,260 @@ Only group admins can use moderation commands.
 📝 Monitoring: Joins/Leaves ✅
 👮 Admin Controls: Available ✅
 ⚙️ Custom Messages: Configured ✅
+📤 Outbound Queue: {'/'.join(map(str, outbound['queued']))} (avg wait {outbound['avg_wait']:.2f}s)
             """
             await update.message.reply_text(status_message, parse_mode='Markdown')
             
         except Exception as e:
             await update.message.reply_text(f"❌ Error getting group status: {str(e)}")
     
+    def remember_member_status(self, member_update):
+        """Promotions, demotions and departures make the cached status stale right away."""
+        new_member = member_update.new_chat_member
+        key = (member_update.chat.id, new_member.user.id)
+        self.admin_cache.invalidate(key)
+        self.admin_cache.set(key, new_member.status)
+    
+    async def track_bot_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Track the bot's own membership (MY_CHAT_MEMBER): added, removed, promoted."""
+        member_update = update.my_chat_member
+        if classify_member_update(member_update) is None:
+            return
+        chat_id = member_update.chat.id
+        self.remember_member_status(member_update)
+        self.bot_reads.forget_chat(chat_id)  # Title, permissions and counts may read differently now
+        logger.info("🤖 Bot status changed to %s", member_update.new_chat_member.status,
+                    extra=log_fields('track_bot_status', chat_id))
+    
     async def track_chats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Track when users join or leave the chat."""
+        # Most member updates are permission edits; drop them before touching anything else
+        kind = classify_member_update(update.chat_member)
+        if kind is None:
+            return
         try:
-            # Check if chat_member update exists
-            if not update.chat_member:
-                print("❌ No chat_member update found")
-                return
-                
-            result = self.extract_status_change(update.chat_member)
+            self.remember_member_status(update.chat_member)
+            new_member = update.chat_member.new_chat_member
+            user = new_member.user
+            chat = update.chat_member.chat
             
-            if result is None:
-                print("❌ No status change detected")
-                return
+            # Keep the user index current for every membership change
+            self.user_store.observe(user, chat.id, new_member.status)
             
-            was_member, is_member = result
-            user = update.chat_member.new_chat_member.user
-            chat = update.effective_chat
+            # Promotions, demotions and restrictions only refresh the caches above; the bot's own
+            # changes arrive as MY_CHAT_MEMBER and are handled by track_bot_status
+            if kind not in (MEMBER_JOIN, MEMBER_LEAVE, MEMBER_BAN) or user.id == context.bot.id:
+                return
+            joined = kind == MEMBER_JOIN
             
-            # Skip if it's the bot itself
-            bot_info = await context.bot.get_me()
-            if user.id == bot_info.id:
-                print("🤖 Skipping bot status change")
+            # Replayed after downtime: no per-member greetings and no raid detection, just a summary per chat
+            if time.time() - update.chat_member.date.timestamp() > STALE_UPDATE_AGE:
+                METRICS.inc('bot_stale_updates_total')
+                self.bot_reads.adjust_member_count(chat.id, 1 if joined else -1)
+                self.catch_up.add(context.bot, chat.id, user, not joined, joined)
                 return
             
             # Get group-specific configuration
-            config = self.get_group_config(str(chat.id))
+            config = await self.get_group_config(str(chat.id))
             
-            # Debug logging with print
-            print(f"👤 Status change detected: {user.full_name} - was_member: {was_member}, is_member: {is_member}")
-            print(f"📊 Old status: {update.chat_member.old_chat_member.status}, New status: {update.chat_member.new_chat_member.status}")
-            print(f"🏷️ Group: {config['group_name']} (ID: {chat.id})")
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug("👤 Status change: %s -> %s (%s) in %s",
+                             update.chat_member.old_chat_member.status, new_member.status, kind, config['group_name'],
+                             extra=log_fields('track_chats', chat.id, user.id))
             
             # User joined
-            if not was_member and is_member:
-                print(f"✅ {user.full_name} JOINED - Sending welcome message...")
+            if joined:
+                self.bot_reads.adjust_member_count(chat.id, 1)
+                if config['global_bans'] and user.id in self.global_bans:
+                    await self.enforce_global_ban(context.bot, chat.id, user)
+                    return  # Banned before any welcome is queued
+                self.recent_joins.add(chat.id, user)
                 
-                # Format the welcome message with user info
-                join_message = config['welcome_message'].format(
-                    user_name=user.full_name,
-                    myanmar_time=get_myanmar_time()
-                )
+                threshold = config['raid_threshold']
+                if self.raid_detector.record_join(chat.id, threshold):
+                    raiders = self.recent_joins.since(chat.id, RAID_WINDOW)
+                    context.application.create_task(self.start_lockdown(context.bot, chat.id, raiders))
+                    return  # start_lockdown mutes this joiner along with the rest of the burst
+                if self.raid_detector.locked_for(chat.id):
+                    await self.restrict_joiner(context.bot, chat.id, user)
+                    return
                 
-                await context.bot.send_message(chat.id, join_message)
-                print(f"✅ Welcome message sent for {user.full_name} in {config['group_name']} - {get_myanmar_time()}")
+                # Joins inside the group's window share one welcome message
+                window = config['greeting_window']
+                await self.greetings.add(context.bot, chat.id, 'join', user.full_name, window)
+                if debug:
+                    logger.debug("✅ Welcome queued for %s", user.full_name, extra=log_fields('track_chats', chat.id, user.id))
             
             # User left or was removed/banned
-            elif was_member and not is_member:
-                print(f"❌ {user.full_name} LEFT/REMOVED - Sending goodbye message...")
-                
-                # Check if user was kicked/banned vs left voluntarily
-                new_status = update.chat_member.new_chat_member.status
-                action_type = "left" if new_status == ChatMemberStatus.LEFT else "removed"
-                
-                # Format the goodbye message with user info
-                leave_message = config['goodbye_message'].format(
-                    user_name=user.full_name,
-                    myanmar_time=get_myanmar_time()
-                )
-                
-                await context.bot.send_message(chat.id, leave_message)
-                print(f"✅ Goodbye message sent for {user.full_name} ({action_type}) in {config['group_name']} - {get_myanmar_time()}")
             else:
-                print(f"🔄 Status change for {user.full_name} but no action needed (was: {was_member}, is: {is_member})")
+                self.bot_reads.adjust_member_count(chat.id, -1)
+                action_type = "left" if kind == MEMBER_LEAVE else "removed"
                 
-        except Exception as e:
-            print(f"🚨 ERROR in track_chats: {e}")
-            import traceback
-            traceback.print_exc()
+                # Leaves inside the group's window share one goodbye message
+                window = config['greeting_window']
+                await self.greetings.add(context.bot, chat.id, 'leave', user.full_name, window)
+                if debug:
+                    logger.debug("✅ Goodbye queued for %s (%s)", user.full_name, action_type,
+                                 extra=log_fields('track_chats', chat.id, user.id))
+                
+        except Exception:
+            logger.exception("🚨 ERROR in track_chats", extra=log_fields('track_chats', update.effective_chat and update.effective_chat.id))
     
-    def extract_status_change(self, chat_member_update):
-        """Extract whether the 'old_chat_member' was a member and whether the 'new_chat_member' is a member."""
-        status_change = chat_member_update.difference().get("status")
-        old_is_member, new_is_member = chat_member_update.difference().get("is_member", (None, None))
-        
-        if status_change is None:
-            return None
-        
-        old_status, new_status = status_change
+    async def send_greeting(self, bot, chat_id, kind, names):
+        """Send one welcome ('join') or goodbye ('leave') message for one or more members."""
+        config = await self.get_group_config(str(chat_id))
+        max_names = config['greeting_max_names']
+        user_name = ", ".join(names[:max_names])
+        if len(names) > max_names:
+            user_name += f" (+{len(names) - max_names} more)"
         
-        # Create compatible admin status lists for both old and new versions
-        admin_statuses = [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR]
+        if kind == 'join' and self.raid_detector.locked_for(chat_id):
+            return  # Welcomes queued before the lockdown started are dropped
         
-        # Try to add both CREATOR and OWNER for compatibility
-        try:
-            admin_statuses.append(ChatMemberStatus.CREATOR)
-        except AttributeError:
-            pass
-        try:
-            admin_statuses.append(ChatMemberStatus.OWNER)
-        except AttributeError:
-            pass
+        template = config['welcome_message'] if kind == 'join' else config['goodbye_message']
+        message = compile_template(template).render(user_name=user_name, myanmar_time=get_myanmar_time())
         
-        # Check if was a member
-        was_member = old_status in admin_statuses or (old_status == ChatMemberStatus.RESTRICTED and old_is_member is True)
+        await bot.send_message(chat_id, message, rate_limit_args={'priority': PRIORITY_GREETING})
+        logger.info("✅ %s message sent for %d member(s) in %s", kind.title(), len(names), config['group_name'],
+                    extra=log_fields('greetings', chat_id=chat_id))
+    
+    async def send_catch_up_summary(self, bot, chat_id, joined, left):
+        """Replace the greetings missed during downtime with one summary message."""
+        config = await self.get_group_config(str(chat_id))
+        if config['global_bans']:
+            for user in [user for user in joined if user.id in self.global_bans]:
+                await self.enforce_global_ban(bot, chat_id, user)
+                joined.remove(user)
+        if not joined and not left:
+            return
         
-        # Check if is currently a member
-        is_member = new_status in admin_statuses or (new_status == ChatMemberStatus.RESTRICTED and new_is_member is True)
+        max_names = config['greeting_max_names']
+        def names(users):
+            text = ", ".join(user.full_name for user in users[:max_names])
+            if len(users) > max_names:
+                text += f" (+{len(users) - max_names} more)"
+            return text
         
-        # Handle kicked/banned status
-        banned_statuses = []
+        lines = ["🔄 While I was offline:"]
+        if joined:
+            lines.append(f"🎉 {len(joined)} joined: {names(joined)}")
+        if left:
+            lines.append(f"👋 {len(left)} left: {names(left)}")
+        lines.append(f"🇲🇲 Myanmar Time: {get_myanmar_time()}")
+        await bot.send_message(chat_id, "\n".join(lines), rate_limit_args={'priority': PRIORITY_GREETING})
+    
+    async def enforce_global_ban(self, bot, chat_id, user):
+        """Ban a joiner who is on the global ban list."""
         try:
-            banned_statuses.append(ChatMemberStatus.KICKED)
-        except AttributeError:
-            pass
+            await bot.ban_chat_member(chat_id, user.id)
+        except Exception as e:
+            logger.warning("❌ Could not ban globally banned user: %s", e, extra=log_fields('track_chats', chat_id, user.id))
+            return
+        self.audit.record(chat_id, 'ban', user, reason='Global ban list', auto=True)
+        logger.info("🌐 Banned globally banned user on join", extra=log_fields('track_chats', chat_id, user.id))
+    
+    async def restrict_joiner(self, bot, chat_id, user):
+        """Mute a member who joined during a lockdown until it ends.
+
+        Telegram lifts the restriction itself at until_date; the expiry scheduler also
+        restores the group's permissions then, or right away on /lockdown off.
+        """
+        until = time.time() + max(self.raid_detector.locked_for(chat_id), LOCKDOWN_MIN_MUTE)
         try:
-            banned_statuses.append(ChatMemberStatus.BANNED)
-        except AttributeError:
-            pass
+            await bot.restrict_chat_member(chat_id, user.id, ChatPermissions.no_permissions(), until_date=int(until))
+        except Exception as e:
+            logger.warning("❌ Could not restrict joiner: %s", e, extra=log_fields('lockdown', chat_id, user.id))
+            return
+        self.audit.record(chat_id, 'mute', user, reason='Joined during lockdown', auto=True, until=until)
+        await self.expirations.schedule(chat_id, user.id, 'lockdown', until)
+    
+    async def start_lockdown(self, bot, chat_id, raiders):
+        """Announce a detected raid and mute the members who joined during it."""
+        joins = len(raiders)
+        logger.warning("🚨 Raid detected: %d joins in %ds, lockdown started", joins, RAID_WINDOW,
+                       extra=log_fields('lockdown', chat_id))
+        self.audit.record(chat_id, 'lockdown', reason=f'{joins} joins in {RAID_WINDOW}s', auto=True)
+        await bot.send_message(
+            chat_id,
+            f"🚨 Raid detected: {joins} joins in {RAID_WINDOW} seconds.\n"
+            f"🔒 Lockdown for {RAID_LOCKDOWN_SECONDS // 60} minutes: new members are muted and welcomes are paused.\n"
+            "👮 Admins can lift it with /lockdown off",
+            rate_limit_args={'priority': PRIORITY_MODERATION}
+        )
+        semaphore = asyncio.Semaphore(MODERATION_CONCURRENCY)
         
-        if new_status in banned_statuses:
-            is_member = False
+        async def restrict(user):
+            async with semaphore:
+                await self.restrict_joiner(bot, chat_id, user)
         
-        return was_member, is_member
+        await asyncio.gather(*(restrict(user) for user in raiders))
+    
+    async def serve_queue(self, update_queue):
+        """Run as a shard worker, handling raw updates sent by the dispatcher until a None arrives."""
+        application = self.application
+        await application.initialize()
+        await self.on_startup(application)
+        await application.start()
+        logger.info("🧩 Shard %d/%d ready", self.shard_index, self.shard_count)
+        try:
+            while True:
+                batch = [await asyncio.to_thread(update_queue.get)]
+                # Drain whatever else is waiting without another thread hop per update
+                while batch[-1] is not None:
+                    try:
+                        batch.append(update_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for data in batch:
+                    if data is None:
+                        return
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            # stop() lets the updates already queued finish before returning
+            await application.stop()
+            await self.on_shutdown(application)
+            await application.shutdown()
     
     def run(self):
         """Start the bot."""
-        print(f"🔒 Multi-Group Security Bot starting... - {get_myanmar_time()}")
-        print("Bot is now running. Press Ctrl+C to stop.")
+        logger.info("🔒 Multi-Group Security Bot starting...")
+        if WEBHOOK_URL:
+            self.run_webhook()
+            return
+        logger.info("Bot is now running. Press Ctrl+C to stop.")
         self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+    
+    def run_webhook(self):
+        """Receive updates over HTTPS instead of long polling."""
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logger.info("🌐 Webhook mode: listening on %s:%d/%s", WEBHOOK_LISTEN, PORT, WEBHOOK_PATH)
+        logger.info("Bot is now running. Press Ctrl+C to stop.")
+        # Every instance behind the load balancer registers the same URL and secret
+        self.application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
 
 def main():
     """Main function to run the bot."""
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+    if UPDATE_SOURCE != 'fake' and BOT_TOKEN in (None, "YOUR_BOT_TOKEN_HERE"):
         print("❌ Please set your bot token in the BOT_TOKEN variable!")
         print("Get your token from @BotFather on Telegram")
         return
+    # Checked before choosing a runtime: without it anyone could POST forged updates
+    if WEBHOOK_URL and UPDATE_SOURCE != 'fake' and not WEBHOOK_SECRET:
+        logger.error("❌ WEBHOOK_SECRET must be set when WEBHOOK_URL is used!")
+        return
+    
+    migrate_shard_layout(SHARD_COUNT)
+    if SHARD_COUNT > 1 or UPDATE_SOURCE == 'fake':
+        ShardedRuntime().run()
+        return
     
     bot = SecurityBot()
     bot.run()
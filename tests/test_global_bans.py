@@ -0,0 +1,37 @@
+import asyncio
+import datetime
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+from telegram import Chat, Message, User  # noqa: E402
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+
+def test_unknown_usernames_are_listed_once_prefixed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        bot = bot_module.SecurityBot(request=bot_module.FakeBotAPIRequest())
+        replies = []
+
+        async def reply(update, context, text, **kwargs):
+            replies.append(text)
+        bot.moderation_reply = reply
+
+        actor = User(bot_module.ADMIN_USER_IDS[0], 'Admin', False)
+        chat = Chat(-100, Chat.SUPERGROUP)
+        message = Message(1, datetime.datetime.now(datetime.timezone.utc), chat, from_user=actor)
+        update = SimpleNamespace(message=message, effective_chat=chat, effective_user=actor)
+        for args in (['@ghost'], ['42', '@ghost']):
+            await bot.update_global_bans(update, SimpleNamespace(args=args), 'gban')
+        await bot.on_shutdown(bot.application)
+        return replies
+
+    replies = asyncio.run(run())
+    assert all(reply.endswith('❓ Not found: @ghost') or '❓ Not found: @ghost\n' in reply for reply in replies)
+    assert not any('@@' in reply for reply in replies)
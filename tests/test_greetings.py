@@ -0,0 +1,29 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+
+def test_flush_sends_names_still_in_open_windows():
+    async def run():
+        sent = []
+
+        async def send(bot, chat_id, kind, names):
+            sent.append((chat_id, kind, names))
+        batcher = bot_module.GreetingBatcher(send)
+        for name in ('Ann', 'Bob', 'Cid'):
+            await batcher.add(None, -1, 'join', name, 60)
+        await batcher.add(None, -2, 'leave', 'Dee', 60)
+        await asyncio.wait_for(batcher.flush(), timeout=1)
+        assert batcher.pending() == 0
+        return sent
+
+    assert sorted(asyncio.run(run())) == [
+        (-2, 'leave', ['Dee']),
+        (-1, 'join', ['Ann']),
+        (-1, 'join', ['Bob', 'Cid']),
+    ]
@@ -0,0 +1,65 @@
+import asyncio
+import datetime
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+from telegram import Chat, Message, User  # noqa: E402
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+CHAT_ID = -100
+
+
+def command(bot, text):
+    actor = User(bot_module.ADMIN_USER_IDS[0], 'Admin', False)
+    chat = Chat(CHAT_ID, Chat.SUPERGROUP)
+    message = Message(1, datetime.datetime.now(datetime.timezone.utc), chat, from_user=actor, text=text)
+    update = SimpleNamespace(message=message, effective_chat=chat, effective_user=actor)
+    context = SimpleNamespace(args=text.split()[1:], bot=bot.application.bot)
+    return update, context
+
+
+def pending(bot):
+    return bot.db.call(lambda conn: conn.execute(
+        'SELECT user_id, action FROM expirations ORDER BY user_id, action').fetchall())
+
+
+def test_ban_and_kick_cancel_pending_mutes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        bot = bot_module.SecurityBot(request=bot_module.FakeBotAPIRequest())
+        await bot.application.initialize()
+        await bot.on_startup(bot.application)
+        lifted = []
+
+        async def lift(chat_id, user_id, action):
+            lifted.append((user_id, action))
+        bot.expirations.lift = lift
+
+        later = time.time() + 3600
+        for user_id in (42, 43, 44):
+            await bot.expirations.schedule(CHAT_ID, user_id, 'mute', later)
+            # As left behind by a raid lockdown (restrict_joiner)
+            await bot.expirations.schedule(CHAT_ID, user_id, 'lockdown', later)
+
+        for action, user_id in (('ban', 42), ('kick', 43)):
+            update, context = command(bot, f'/{action} {user_id}')
+            await bot.moderate(update, context, action)
+        assert pending(bot) == [(44, 'lockdown'), (44, 'mute')]
+
+        # A temporary ban replaces the mutes with its own expiry
+        update, context = command(bot, '/tempban 1h 44')
+        await bot.moderate(update, context, 'ban', duration=3600)
+        assert pending(bot) == [(44, 'ban')]
+        assert lifted == []
+
+        await bot.application.shutdown()
+        await bot.on_shutdown(bot.application)
+
+    asyncio.run(run())
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+from telegram import User  # noqa: E402
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+
+def resolve(tmp_path, args, reply_to=None):
+    async def run():
+        db = bot_module.SQLiteDatabase(str(tmp_path / 'users.db'))
+        store = bot_module.UserStore(db)
+        store.observe(User(555, 'Spam', False, username='spammer'), -1)
+        store.observe(User(777, 'Other', False, username='other'), -1)
+        bot = SimpleNamespace(user_store=store, recent_joins=SimpleNamespace(since=lambda chat_id, seconds: []))
+        bot._is_target_token = bot_module.SecurityBot._is_target_token.__get__(bot)
+        reply = SimpleNamespace(from_user=reply_to) if reply_to else None
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=-1), message=SimpleNamespace(reply_to_message=reply))
+        targets, unknown, reason = await bot_module.SecurityBot.resolve_targets(bot, update, SimpleNamespace(args=args))
+        db.close()
+        return [target.id for target in targets], unknown, reason
+    return asyncio.run(run())
+
+
+def test_leading_unknown_id_is_a_target(tmp_path):
+    assert resolve(tmp_path, ['123456789']) == ([123456789], [], None)
+    assert resolve(tmp_path, ['123456789', 'spam']) == ([123456789], [], 'spam')
+
+
+def test_number_after_a_target_starts_the_reason(tmp_path):
+    assert resolve(tmp_path, ['@spammer', '100', 'spam', 'messages']) == ([555], [], '100 spam messages')
+    reply_author = User(999, 'Author', False)
+    assert resolve(tmp_path, ['100', 'spam'], reply_to=reply_author) == ([999], [], '100 spam')
+
+
+def test_known_or_marked_ids_after_a_target(tmp_path):
+    assert resolve(tmp_path, ['@spammer', '777', 'x']) == ([555, 777], [], 'x')
+    assert resolve(tmp_path, ['@spammer', 'id:100', '@ghost', '5']) == ([555, 100], ['@ghost'], '5')
@@ -0,0 +1,48 @@
+import asyncio
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+from telegram import Chat, Message, Update  # noqa: E402
+
+import telegram_security_bot as bot_module  # noqa: E402
+
+
+def make_update(update_id, chat_id):
+    chat = Chat(chat_id, Chat.SUPERGROUP)
+    message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat, text='hi')
+    return Update(update_id, message=message)
+
+
+def test_busy_chat_does_not_block_other_chats():
+    async def run():
+        processor = bot_module.ChatOrderedUpdateProcessor(4)
+        release = asyncio.Event()
+        handled = []
+
+        async def slow(update_id):
+            await release.wait()
+            handled.append(update_id)
+
+        async def fast(update_id):
+            handled.append(update_id)
+
+        # More queued updates for chat 1 than there are slots
+        busy = [
+            asyncio.create_task(processor.process_update(make_update(i, -1), slow(i)))
+            for i in range(10)
+        ]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(make_update(100, -2), fast(100)))
+        await asyncio.wait_for(other, timeout=1)
+        assert handled == [100]
+
+        release.set()
+        await asyncio.gather(*busy)
+        assert handled == [100] + list(range(10))
+        assert processor.busy_chats() == 0
+
+    asyncio.run(run())
@@ -0,0 +1,92 @@
+"""Local test harness for webhook mode.
+
+Start the bot with WEBHOOK_URL/WEBHOOK_SECRET set, then POST canned updates to it:
+
+    python webhook_harness.py --url http://localhost:8443/telegram --secret <WEBHOOK_SECRET>
+
+Every canned update is sent --repeat times with --concurrency requests in flight,
+and one request with a wrong secret is sent to check that it is rejected.
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def canned_updates(chat_id, user_id):
+    """Yield one update of each kind the bot handles."""
+    now = int(time.time())
+    chat = {'id': chat_id, 'type': 'supergroup', 'title': 'Harness Group'}
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Harness', 'username': f'harness{user_id}'}
+    member = {'user': user, 'status': 'member'}
+    left = {'user': user, 'status': 'left'}
+
+    yield 'message', {'message': {'message_id': 1, 'date': now, 'chat': chat, 'from': user, 'text': 'hello'}}
+    yield 'command', {'message': {
+        'message_id': 2, 'date': now, 'chat': chat, 'from': user, 'text': '/help',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+    }}
+    yield 'join', {'chat_member': {
+        'chat': chat, 'from': user, 'date': now, 'old_chat_member': left, 'new_chat_member': member,
+    }}
+    yield 'leave', {'chat_member': {
+        'chat': chat, 'from': user, 'date': now, 'old_chat_member': member, 'new_chat_member': left,
+    }}
+
+
+async def post(client, url, secret, update):
+    started = time.perf_counter()
+    response = await client.post(url, json=update, headers={SECRET_HEADER: secret})
+    return response.status_code, time.perf_counter() - started
+
+
+async def run(args):
+    jobs = []
+    update_id = args.first_update_id
+    for i in range(args.repeat):
+        for kind, update in canned_updates(args.chat_id, args.user_id + i):
+            jobs.append((kind, {'update_id': update_id, **update}))
+            update_id += 1
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = {}
+
+    async with httpx.AsyncClient(timeout=10) as client:
+        async def send(kind, update):
+            async with semaphore:
+                status, latency = await post(client, args.url, args.secret, update)
+            results.setdefault(kind, []).append((status, latency))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(kind, update) for kind, update in jobs))
+        elapsed = time.perf_counter() - started
+
+        bad_status, _ = await post(client, args.url, args.secret + 'x', jobs[0][1])
+
+    print(f"Sent {len(jobs)} updates in {elapsed:.2f}s ({len(jobs) / elapsed:.0f}/s)")
+    for kind, samples in results.items():
+        latencies = sorted(latency for _, latency in samples)
+        ok = sum(1 for status, _ in samples if status == 200)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        print(f"  {kind:8} {ok}/{len(samples)} ok  p50 {p50:.1f}ms  p99 {p99:.1f}ms")
+    print(f"Wrong secret -> HTTP {bad_status} ({'rejected' if bad_status == 403 else 'NOT rejected'})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8443/telegram')
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--chat-id', type=int, default=-1001234567890)
+    parser.add_argument('--user-id', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=25)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--first-update-id', type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()